@@ -0,0 +1,560 @@
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from dispatch import CommandDispatcher
+from matching import AnswerMatcher, TrigramIndex, slugify
+from millionaire_stats import *
+from outbox import Outbox
+from worker_pool import create_worker_pool
+
+
+def random_text(rng, min_length, max_length):
+    words = [u'the', u'which', u'of', u'these', u'was', u'first', u'famous', u'capital', u'album', u'released', u'known', u'caf\xe9']
+    text = u' '.join(rng.choice(words) for _ in range(rng.randint(2, 40)))
+    return text[:rng.randint(min_length, max_length)] or u'?'
+
+
+def random_title(rng):
+    # titles share a few common words but are otherwise mostly distinct
+    common = [u'the', u'of', u'a', u'and', u'2', u'part', u'return', u'night', u'man', u'star']
+    words = []
+    for _ in range(rng.randint(1, 5)):
+        if rng.random() < 0.3:
+            words.append(rng.choice(common))
+        else:
+            words.append(u''.join(rng.choice(u'abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 9))))
+    return u' '.join(words).title()
+
+
+def random_question(rng):
+    question = Question()
+    question.category = QUESTION_CATEGORY_MAP[rng.randint(9, 32)]
+    question.type = u'multiple'
+    question.difficulty = QUESTION_DIFFICULTY_MAP[rng.randint(0, 2)]
+    question.question = random_text(rng, 30, 200)
+    question.correct_answer = random_text(rng, 3, 30)
+    question.incorrect_answers = [random_text(rng, 3, 30) for _ in range(3)]
+    return question
+
+
+def random_game(rng, user, question_pool):
+    rounds = []
+    score = 0
+    for question_amount in sorted(amount for amount in DOLLAR_AMOUNT_MAP if amount >= 500):
+        question = rng.choice(question_pool)
+        if rng.random() < 0.8:
+            rounds.append(MillionaireRound(question, question_amount, rng.randint(0, 3), question.correct_answer))
+            score = question_amount
+        else:
+            rounds.append(MillionaireRound(question, question_amount, rng.randint(0, 3), rng.choice(question.incorrect_answers)))
+            break
+    return MillionaireGame(user, Lifeline.FiftyFifty | Lifeline.DoubleDip, rounds, timestamp(), score)
+
+
+def random_question_pool(rng, size=4000):
+    # OpenTDB only has a few thousand questions, so players see the same ones over and over
+    return [random_question(rng) for _ in range(size)]
+
+
+def write_games_file(path, user, games, seed=0, version=MGD_VERSION, question_pool=None):
+    rng = random.Random(seed)
+    if question_pool is None:
+        question_pool = random_question_pool(rng)
+    question_table = get_game_question_table(path, version)
+    with open(path, 'wb') as write_byte_stream:
+        write_header(write_byte_stream, version)
+        for _ in range(games):
+            write_record(write_byte_stream, random_game(rng, user, question_pool), question_table)
+
+
+def write_history(stats_dir, users, games, seed=0, version=MGD_VERSION, ext='.mgd'):
+    # users x games, all drawing from one question pool like the real bot
+    os.makedirs(stats_dir, exist_ok=True)
+    rng = random.Random(seed)
+    question_pool = random_question_pool(rng)
+    user_ids = [str(rng.randrange(10 ** 17, 10 ** 18)) for _ in range(users)]
+    for index, user_id in enumerate(user_ids):
+        write_games_file(os.path.join(stats_dir, user_id + ext), user_id, games, seed + index, version, question_pool)
+    return user_ids
+
+
+def random_movie(rng, quotes):
+    characters = [random_title(rng) for _ in range(rng.randint(1, 8))]
+    return {
+        'title': random_title(rng),
+        'quotes': [
+            {
+                'text': random_text(rng, 10, 300),
+                'character': rng.choice(characters) if rng.random() < 0.9 else None,
+            } for _ in range(rng.randint(1, quotes))
+        ],
+    }
+
+
+def write_quote_corpus(quotes_dir, titles, quotes=60, seed=0):
+    # same layout as movie_quotes/, returns the titles written
+    os.makedirs(quotes_dir, exist_ok=True)
+    rng = random.Random(seed)
+    written = []
+    for _ in range(titles):
+        movie = random_movie(rng, quotes)
+        path = os.path.join(quotes_dir, slugify(movie['title']) + '.json')
+        if not os.path.exists(path):
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(movie, f)
+            written.append(movie['title'])
+    return written
+
+
+def timed(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min([best, elapsed])
+    return best
+
+
+def bench_game_io(games=5000):
+    rng = random.Random(0)
+    question_pool = random_question_pool(rng)
+    game_list = [random_game(rng, u'170903342199865344', question_pool) for _ in range(games)]
+    buf = io.BytesIO()
+
+    def write():
+        buf.seek(0)
+        buf.truncate()
+        for game in game_list:
+            game.write(buf)
+
+    write_time = timed(write)
+    data = buf.getvalue()
+
+    def read():
+        read_byte_stream = io.BytesIO(data)
+        for _ in range(games):
+            MillionaireGame.read(read_byte_stream)
+
+    read_time = timed(read)
+    print(u'MillionaireGame: write {:,.0f} games/s, read {:,.0f} games/s ({:.1f} MB)'.format(games / write_time, games / read_time, len(data) / 1e6))
+    return {
+        'games': games,
+        'bytes': len(data),
+        'write_games_per_second': games / write_time,
+        'read_games_per_second': games / read_time,
+    }
+
+
+def bench_readers(games=5000):
+    results = {}
+    for version in (1, MGD_VERSION):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, '170903342199865344.mgd')
+            write_games_file(path, u'170903342199865344', games, version=version)
+            size = sum(os.path.getsize(os.path.join(temp_dir, filename)) for filename in os.listdir(temp_dir))
+            elapsed = {}
+            for name, reader in sorted(GAME_READERS.items()):
+                QUESTION_TABLES.clear()
+                elapsed[name] = timed(lambda: sum(1 for _ in reader(path)))
+            print(u'version {}: {} games, {:.1f} MB'.format(version, games, size / 1e6))
+            for name, seconds in sorted(elapsed.items()):
+                print(u'  {:<8}{:>8.3f}s{:>10,.0f} games/s'.format(name, seconds, games / seconds))
+            print(u'  mmap speedup: {:.1f}x'.format(elapsed['stream'] / elapsed['mmap']))
+            results['v{}'.format(version)] = dict(bytes=size, **{name + '_games_per_second': games / seconds for name, seconds in elapsed.items()})
+    return results
+
+
+def bench_parallel_summaries(users=20000, games=10, worker_counts=(1, 2, 4, 8)):
+    # cold leaderboard rebuild: every user's file summarized from scratch, split into chunks like rebuild_millionaire_index
+    results = {'users': users, 'games': games, 'cpus': os.cpu_count()}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        user_ids = write_history(temp_dir, users, games)
+        jobs = [(os.path.join(temp_dir, user_id + '.mgd'), None) for user_id in user_ids]
+        QUESTION_TABLES.clear()
+        results['in_process_seconds'] = timed(lambda: summarize_game_files(jobs, 'mmap'), repeat=1)
+        print(u'summaries of {:,} users x {} games: in process {:.2f}s'.format(users, games, results['in_process_seconds']))
+        for workers in worker_counts:
+            QUESTION_TABLES.clear()
+            chunk_size = max([1, len(jobs) // (workers * 4)])
+            chunks = [jobs[start:start + chunk_size] for start in range(0, len(jobs), chunk_size)]
+            # the pool lilbot uses, already started
+            with create_worker_pool(workers) as pool:
+                elapsed = timed(lambda: sum(len(summaries) for summaries in pool.map(summarize_game_files, chunks, ['mmap'] * len(chunks))), repeat=1)
+            results['{}_workers_seconds'.format(workers)] = elapsed
+            print(u'  {} workers: {:.2f}s ({:.1f}x)'.format(workers, elapsed, results['in_process_seconds'] / elapsed))
+    return results
+
+
+def random_messages(rng, commands, count):
+    # mostly chatter, like a real channel
+    messages = []
+    for _ in range(count):
+        if rng.random() < 0.1:
+            messages.append(rng.choice(commands) + u' some arguments')
+        else:
+            messages.append(random_text(rng, 1, 120))
+    return messages
+
+
+def bench_dispatch(messages=20000):
+    rng = random.Random(0)
+    results = {}
+    for command_count in (10, 100, 1000):
+        commands = [u'!{}'.format(random_text(rng, 3, 12).replace(u' ', u'')) for _ in range(command_count)]
+        stream = random_messages(rng, commands, messages)
+        dispatcher = CommandDispatcher((command, command) for command in commands)
+
+        def linear():
+            for message in stream:
+                for command in commands:
+                    if message.startswith(command):
+                        break
+
+        def trie():
+            for message in stream:
+                dispatcher.match(message)
+
+        linear_ns = timed(linear) / messages * 1e9
+        trie_ns = timed(trie) / messages * 1e9
+        print(u'{} commands: linear {:.0f} ns/message, trie {:.0f} ns/message'.format(command_count, linear_ns, trie_ns))
+        results[str(command_count)] = {'linear_ns_per_message': linear_ns, 'trie_ns_per_message': trie_ns}
+    return results
+
+
+def bench_slugify(count=20000):
+    rng = random.Random(0)
+    titles = [random_title(rng) for _ in range(count)]
+    messages = [random_text(rng, 1, 120) for _ in range(count)]
+    results = {}
+    for name, stream in (('titles', titles), ('messages', messages)):
+        elapsed = timed(lambda: [slugify(text) for text in stream])
+        results[name + '_per_second'] = count / elapsed
+    print(u'slugify: {:,.0f} titles/s, {:,.0f} messages/s'.format(results['titles_per_second'], results['messages_per_second']))
+    return results
+
+
+def bench_matcher(messages=20000):
+    rng = random.Random(0)
+    characters = [u'Tony Stark', u'Darth Vader', u'The Dude', u'Ellen Ripley', u'Gandalf', u'Hannibal Lecter']
+    stream = [random_text(rng, 1, 80) for _ in range(messages)]
+    for index in range(0, messages, 10):
+        stream[index] = rng.choice([u'tony', u'darth vadr', u'its the dude', u'ripley!', u'Gandalf the grey', u'hanibal'])
+
+    def slug_check():
+        for character in characters:
+            expected = slugify(character.strip())
+            for message in stream:
+                expected in slugify(message.strip())
+
+    def matcher_check():
+        for character in characters:
+            matcher = AnswerMatcher(character)
+            for message in stream:
+                matcher.match(message)
+
+    total = messages * len(characters)
+    results = {
+        'slugify_messages_per_second': total / timed(slug_check),
+        'matcher_messages_per_second': total / timed(matcher_check),
+    }
+    print(u'answer matching: slugify {:,.0f} messages/s, AnswerMatcher {:,.0f} messages/s'.format(
+        results['slugify_messages_per_second'], results['matcher_messages_per_second']))
+    return results
+
+
+def bench_title_search(titles=5000, queries=1000):
+    rng = random.Random(0)
+    title_search = TrigramIndex()
+    names = [random_title(rng) for _ in range(titles)]
+    for name in names:
+        title_search.add(slugify(name), name)
+    # drop a character from each query, like a typo
+    stream = []
+    for _ in range(queries):
+        name = rng.choice(names)
+        index = rng.randrange(len(name))
+        stream.append(name[:index] + name[index + 1:])
+
+    def search():
+        for query in stream:
+            title_search.best(query)
+
+    ms_per_query = timed(search) * 1000 / queries
+    print(u'title search over {:,} titles: {:.3f} ms/query'.format(titles, ms_per_query))
+    return {'titles': titles, 'ms_per_query': ms_per_query}
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class FakeDiscord:
+    # fixed windows of limit sends per period for each channel, a 429 (RateLimited) past that.
+    # also the transport test_outbox checks the outbox against.
+    def __init__(self, limit=5, period=0.2, latency=0.001, max_length=2000):
+        self.limit = limit
+        self.period = period
+        self.latency = latency
+        self.max_length = max_length
+        # channel -> (window start, sends in window)
+        self.windows = {}
+        # (channel, content, kwargs, time)
+        self.sent = []
+        self.rejected = 0
+        # raised by every send when set
+        self.error = None
+        # sends wait for this event when set
+        self.blocked = None
+
+    async def send_message(self, channel, content=None, **kwargs):
+        if self.blocked is not None:
+            await self.blocked.wait()
+        await asyncio.sleep(self.latency)
+        if self.error is not None:
+            raise self.error
+        now = time.monotonic()
+        start, count = self.windows.get(channel, (now, 0))
+        if now - start >= self.period:
+            start, count = now, 0
+        if count >= self.limit:
+            self.rejected += 1
+            raise RateLimited(start + self.period - now)
+        assert content is None or len(content) <= self.max_length
+        self.windows[channel] = (start, count + 1)
+        self.sent.append((channel, content, kwargs, now))
+        return (channel, content)
+
+    def lines(self, channel):
+        return [line for sent_channel, content, _, _ in self.sent if sent_channel == channel for line in content.split('\n')]
+
+
+def retry_after(e):
+    return e.retry_after if isinstance(e, RateLimited) else None
+
+
+def bench_outbox(channels=8, questions=10, limit=5, period=0.25):
+    # every game sends a question and waits for it to go out, as lilbot does before it starts the answer timer,
+    # then posts a verdict and two more status lines and waits a moment for answers
+    rng = random.Random(0)
+    results = {}
+
+    async def send_retrying(discord, channel, content):
+        # what send_message did before the outbox, wait out every 429 in the game loop
+        while True:
+            try:
+                return await discord.send_message(channel, content)
+            except RateLimited as e:
+                await asyncio.sleep(e.retry_after)
+
+    async def game(send, post, channel, stalls):
+        for question in range(questions):
+            for line in range(4):
+                start = time.perf_counter()
+                await (send if line == 0 else post)(channel, u'{} {} {}'.format(question, line, random_text(rng, 10, 200)))
+                stalls.append(time.perf_counter() - start)
+            await asyncio.sleep(period / 10)
+
+    for name in ('direct', 'outbox'):
+        discord = FakeDiscord(limit, period)
+        # FakeDiscord has no global limit, so neither does the outbox here
+        outbox = Outbox(discord.send_message, limit, period, channels * limit, period, retry_after=retry_after)
+        if name == 'direct':
+            send = post = lambda channel, content: send_retrying(discord, channel, content)
+        else:
+            send, post = outbox.send, outbox.post
+        stalls = []
+        loop = asyncio.new_event_loop()
+
+        async def run():
+            await asyncio.gather(*[game(send, post, channel, stalls) for channel in range(channels)])
+            await asyncio.gather(*[queue.task for queue in outbox.channels.values()])
+
+        start = time.perf_counter()
+        loop.run_until_complete(run())
+        elapsed = time.perf_counter() - start
+        loop.close()
+        stalls.sort()
+        results[name] = {
+            'seconds': elapsed,
+            'sends': len(discord.sent),
+            'rejected': discord.rejected,
+            'p99_stall_ms': stalls[int(len(stalls) * 0.99)] * 1000,
+        }
+        print(u'{} sends: {:.2f}s, {} sends, {} rate limited, p99 game loop stall {:.1f} ms'.format(
+            name, elapsed, len(discord.sent), discord.rejected, results[name]['p99_stall_ms']))
+    return results
+
+
+def import_lilbot(work_dir):
+    # lilbot keeps its state in the working directory, so point it at a scratch one before importing
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(work_dir)
+    try:
+        import lilbot
+    except ImportError as e:
+        print(u'skipping lilbot benchmarks: {}'.format(e))
+        return None
+    return lilbot
+
+
+def bench_load_scans(lilbot, work_dir, users=50, games=200):
+    lilbot.MILLIONAIRE_STATS_DIR = os.path.join(work_dir, 'scan_stats')
+    user_ids = write_history(lilbot.MILLIONAIRE_STATS_DIR, users, games)
+    results = {'users': users, 'games': games}
+    for reader in sorted(GAME_READERS):
+        QUESTION_TABLES.clear()
+        elapsed = timed(lambda: [sum(1 for _ in lilbot.load_millionaire_games(user_id, reader)) for user_id in user_ids])
+        results[reader + '_games_per_second'] = users * games / elapsed
+        print(u'load_millionaire_games ({}): {:,.0f} games/s over {} users x {} games'.format(reader, users * games / elapsed, users, games))
+    return results
+
+
+def bench_leaderboard(lilbot, work_dir, users=50, games=200):
+    lilbot.MILLIONAIRE_STATS_DIR = os.path.join(work_dir, 'leaderboard_stats')
+    user_ids = write_history(lilbot.MILLIONAIRE_STATS_DIR, users, games)
+
+    def rank():
+        summaries = [summary for summary in lilbot.millionaire_index.values() if summary.games_played]
+        summaries.sort(key=lambda summary: summary.total_earned, reverse=True)
+
+    def cold():
+        # no summaries yet, every game gets decoded
+        lilbot.millionaire_index.clear()
+        QUESTION_TABLES.clear()
+        lilbot.refresh_millionaire_index()
+        rank()
+
+    def warm():
+        # one new game per user since the last refresh
+        rng = random.Random(0)
+        question_pool = random_question_pool(rng, 100)
+        for user_id in user_ids:
+            lilbot.append_game(lilbot.get_millionaire_game_path(user_id), random_game(rng, user_id, question_pool))
+        lilbot.refresh_millionaire_index()
+        rank()
+
+    results = {'users': users, 'games': games, 'cold_seconds': timed(cold), 'warm_seconds': timed(warm)}
+    print(u'leaderboard over {} users x {} games: cold {:.3f}s, warm {:.3f}s'.format(users, games, results['cold_seconds'], results['warm_seconds']))
+    return results
+
+
+def bench_load_movie(lilbot, work_dir, titles=500):
+    lilbot.QUOTES_DIR = os.path.join(work_dir, 'movie_quotes')
+    written = write_quote_corpus(lilbot.QUOTES_DIR, titles)
+
+    def cold():
+        lilbot.movie_cache = lilbot.MovieCache(lilbot.MOVIE_CACHE_ENTRIES, lilbot.MOVIE_CACHE_BYTES)
+        for title in written:
+            lilbot.load_movie(title)
+
+    def warm():
+        for title in written:
+            lilbot.load_movie(title)
+
+    results = {'titles': len(written), 'cold_per_second': len(written) / timed(cold), 'warm_per_second': len(written) / timed(warm)}
+    print(u'load_movie over {} titles: cold {:,.0f}/s, warm {:,.0f}/s'.format(len(written), results['cold_per_second'], results['warm_per_second']))
+    return results
+
+
+def bench_on_message(lilbot, messages=20000):
+    rng = random.Random(0)
+    commands = [command_text for command_text, *_ in lilbot.COMMANDS]
+    stream = random_messages(rng, commands, messages)
+    channel = SimpleNamespace(id=u'170903342199865344')
+    author = SimpleNamespace(id=u'170903342199865344')
+    # commands talk to Discord, so only chatter goes through on_message, commands are matched but not run
+    chatter = [SimpleNamespace(author=author, channel=channel, content=content) for content in stream if not lilbot.command_dispatcher.match(content)]
+    loop = asyncio.new_event_loop()
+
+    def route():
+        for message in chatter:
+            loop.run_until_complete(lilbot.on_message(message))
+
+    def match():
+        for content in stream:
+            lilbot.command_dispatcher.match(content)
+
+    results = {
+        'on_message_us_per_message': timed(route) / len(chatter) * 1e6,
+        'match_ns_per_message': timed(match) / messages * 1e9,
+    }
+    loop.close()
+    print(u'on_message: {:.1f} us/message, command match {:.0f} ns/message'.format(results['on_message_us_per_message'], results['match_ns_per_message']))
+    return results
+
+
+BENCHMARKS = [
+    ('game_io', bench_game_io),
+    ('readers', bench_readers),
+    ('dispatch', bench_dispatch),
+    ('slugify', bench_slugify),
+    ('matcher', bench_matcher),
+    ('title_search', bench_title_search),
+    ('parallel_summaries', bench_parallel_summaries),
+    ('outbox', bench_outbox),
+]
+
+LILBOT_BENCHMARKS = [
+    ('load_scans', lambda lilbot, work_dir: bench_load_scans(lilbot, work_dir)),
+    ('leaderboard', lambda lilbot, work_dir: bench_leaderboard(lilbot, work_dir)),
+    ('load_movie', lambda lilbot, work_dir: bench_load_movie(lilbot, work_dir)),
+    ('on_message', lambda lilbot, work_dir: bench_on_message(lilbot)),
+]
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(results_path='benchmark_results.jsonl', names=()):
+    # appends one JSON line per run, so runs on different commits can be compared
+    results_path = os.path.abspath(results_path)
+    results = {}
+    for name, bench in BENCHMARKS:
+        if not names or name in names:
+            results[name] = bench()
+    if not names or any(name in names for name, _ in LILBOT_BENCHMARKS):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as work_dir:
+            try:
+                lilbot = import_lilbot(work_dir)
+                if lilbot:
+                    for name, bench in LILBOT_BENCHMARKS:
+                        if not names or name in names:
+                            results[name] = bench(lilbot, work_dir)
+            finally:
+                os.chdir(cwd)
+    run = {
+        'time': time.time(),
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    with open(results_path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(run) + '\n')
+    print(u'Results appended to {}.'.format(results_path))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] in ('-h', '--help'):
+        print('usage: python benchmarks.py [results_path [benchmark ...]]')
+        print('benchmarks: ' + u', '.join(name for name, _ in BENCHMARKS + LILBOT_BENCHMARKS))
+    else:
+        main(*sys.argv[1:2], names=sys.argv[2:])
@@ -0,0 +1,30 @@
+class CommandDispatcher:
+    # character trie over command strings. match() picks the longest command the text starts with,
+    # so "!qtrivia add" wins over "!qtrivia" no matter which was registered first.
+    def __init__(self, commands=()):
+        self.root = {}
+        # first characters of every command, anything else can't be a command
+        self.sigils = set()
+        for command_string, value in commands:
+            self.add(command_string, value)
+
+    def add(self, command_string, value):
+        node = self.root
+        for char in command_string:
+            node = node.setdefault(char, {})
+        # None can't collide with a character, so it marks where a command ends
+        node[None] = (command_string, value)
+        self.sigils.add(command_string[0])
+
+    def match(self, text):
+        # (command_string, value) or None
+        if not text or text[0] not in self.sigils:
+            return None
+        node = self.root
+        found = None
+        for char in text:
+            node = node.get(char, None)
+            if node is None:
+                break
+            found = node.get(None, found)
+        return found
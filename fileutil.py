@@ -0,0 +1,10 @@
+import json
+import os
+
+
+def atomic_write_json(path, obj, **kwargs):
+    # written next to path and renamed over it, so readers see either the old file or the whole new one
+    temp_path = path + '.temp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(obj, f, **kwargs)
+    os.replace(temp_path, path)
@@ -1,17 +1,31 @@
 import asyncio
+import functools
 import html
 import json
 import os
 import random
-import re
 import time
-import unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures.process import BrokenProcessPool
+from itertools import chain
 
 import discord
 import requests
 from imdbpie import Imdb
 
+from dispatch import CommandDispatcher
+from fileutil import atomic_write_json
+from matching import AnswerMatcher, TrigramIndex, sequel_tokens, slugify
+from metrics import metrics
 from millionaire_stats import *
+from opentdb import OpenTDBClient, ResponseCache, build_category_index, resolve_category
+from outbox import Outbox
+from profiler import CommandProfiler
+from question_bank import MILLIONAIRE_HISTORY_IMPORT, QuestionBank, import_millionaire_history, read_millionaire_history
+from quote_pack import QuotePack
+from ranking import Ranking
+from sessions import SessionManager, TimerWheel
+from worker_pool import create_worker_pool
 
 
 class Cache:
@@ -73,6 +87,240 @@ class TimeCache:
         return item in self.items
 
 
+class WriteBehind:
+    # coalesces saves so write() runs at most once every delay seconds, off the hot path
+    def __init__(self, write, delay):
+        self.write = write
+        self.delay = delay
+        self.dirty = False
+        self.handle = None
+        self.writes = 0
+        self.coalesced = 0
+
+    def mark_dirty(self):
+        if self.dirty:
+            self.coalesced += 1
+            return
+        self.dirty = True
+        self.handle = asyncio.get_event_loop().call_later(self.delay, self.flush)
+
+    def flush(self):
+        if self.handle:
+            self.handle.cancel()
+            self.handle = None
+        if self.dirty:
+            self.dirty = False
+            self.write()
+            self.writes += 1
+
+    def stats(self):
+        return {
+            'writes': self.writes,
+            'coalesced': self.coalesced,
+        }
+
+
+class MovieCache:
+    # LRU of parsed movies, keyed by path and only valid while the file's (mtime, size) is unchanged
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def stat(path):
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def get(self, path, stat):
+        entry = self.entries.get(path, None)
+        if entry and entry[0] == stat:
+            self.hits += 1
+            self.entries.move_to_end(path)
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def put(self, path, stat, movie):
+        self.invalidate(path)
+        # file size is a decent stand-in for the parsed size
+        self.entries[path] = (stat, movie)
+        self.bytes += stat[1]
+        while self.entries and ((self.max_entries and len(self.entries) > self.max_entries) or (self.max_bytes and self.bytes > self.max_bytes)):
+            _, (stat, _) = self.entries.popitem(last=False)
+            self.bytes -= stat[1]
+            self.evictions += 1
+
+    def invalidate(self, path):
+        entry = self.entries.pop(path, None)
+        if entry:
+            self.bytes -= entry[0][1]
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class TitleIndex:
+    # query slug -> canonical title from past lookups, plus recent lookups that found nothing
+    # bumped whenever what may be saved changes, so older mappings are dropped instead of trusted
+    VERSION = 2
+
+    def __init__(self, path, negative_ttl):
+        self.path = path
+        self.negative_ttl = negative_ttl
+        try:
+            index = json.load(open(path, 'r', encoding='utf-8'))
+        except (IOError, ValueError):
+            index = {}
+        if not isinstance(index, dict) or index.get('version', None) != self.VERSION:
+            index = {}
+        self.titles = index.get('titles', {})
+        now = time.time()
+        self.misses = {query: when for query, when in index.get('misses', {}).items() if now - when < negative_ttl}
+
+    def get(self, query):
+        return self.titles.get(slugify(query), None)
+
+    def is_missing(self, query):
+        when = self.misses.get(slugify(query), None)
+        return when is not None and time.time() - when < self.negative_ttl
+
+    def add(self, query, title):
+        for alias in (query, title):
+            self.titles[slugify(alias)] = title
+            self.misses.pop(slugify(alias), None)
+        self.save()
+
+    def add_missing(self, query):
+        self.misses[slugify(query)] = time.time()
+        self.save()
+
+    def save(self):
+        atomic_write_json(self.path, {'version': self.VERSION, 'titles': self.titles, 'misses': self.misses})
+
+
+class NameCache:
+    # user id -> Discord name, kept across restarts. names past their ttl are still served, just refreshed soon after.
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        try:
+            self.names = json.load(open(path, 'r', encoding='utf-8'))
+        except (IOError, ValueError):
+            self.names = {}
+        # user id -> task of the lookup in flight, so each is only looked up once at a time
+        self.pending = {}
+
+    def get(self, user_id):
+        entry = self.names.get(user_id, None)
+        return entry[0] if entry else None
+
+    def is_stale(self, user_id):
+        entry = self.names.get(user_id, None)
+        return entry is None or time.time() - entry[1] >= self.ttl
+
+    def put(self, user_id, name):
+        self.names[user_id] = [name, time.time()]
+
+    def save(self):
+        atomic_write_json(self.path, self.names)
+
+
+class QuestionReservoir:
+    def __init__(self, fetch, watermarks, retry_delay=10, max_retry_delay=10 * 60, log_interval=None):
+        # fetch(amount, category=None, difficulty=None) -> [Question] or None
+        self.fetch = fetch
+        # (difficulty, category) -> (low, high). refills to high once a buffer drops below low
+        self.watermarks = watermarks
+        # a failed refill waits retry_delay, doubling with every failure in a row up to max_retry_delay
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        # seconds between printing stats(), None to never print them
+        self.log_interval = log_interval
+        self.questions = {key: deque() for key in watermarks}
+        # key -> (failures in a row, time of the next attempt)
+        self.backoff = {}
+        self.last_log = time.time()
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.refill_failures = 0
+        self.refill_time = 0.0
+        self.last_refill_time = None
+
+    def start(self, loop):
+        if self.task is None or self.task.done():
+            self.task = loop.create_task(self.run())
+
+    async def take(self, amount, difficulty=None, category=None):
+        buffered = self.questions.get((difficulty, category), None)
+        self.wakeup.set()
+        if buffered is not None and len(buffered) >= amount:
+            self.hits += 1
+            return [buffered.popleft() for _ in range(amount)]
+        self.misses += 1
+        return await self.fetch(amount, category=category, difficulty=difficulty)
+
+    async def refill(self, key, amount):
+        difficulty, category = key
+        start = time.time()
+        questions = await self.fetch(amount, category=category, difficulty=difficulty)
+        self.last_refill_time = time.time() - start
+        self.refill_time += self.last_refill_time
+        if questions:
+            self.refills += 1
+            self.questions[key].extend(questions)
+            self.backoff.pop(key, None)
+            return True
+        self.refill_failures += 1
+        failures = self.backoff.get(key, (0, None))[0] + 1
+        delay = min(self.retry_delay * 2 ** (failures - 1), self.max_retry_delay)
+        self.backoff[key] = (failures, time.time() + delay)
+        print('Unable to refill {}/{} questions, retrying in {}s.'.format(difficulty, category, delay))
+        return False
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            for key, (low, high) in self.watermarks.items():
+                buffered = self.questions[key]
+                failures, retry_time = self.backoff.get(key, (0, None))
+                if len(buffered) < low and (retry_time is None or time.time() >= retry_time):
+                    await self.refill(key, high - len(buffered))
+            if self.log_interval and time.time() - self.last_log >= self.log_interval:
+                self.last_log = time.time()
+                print('Question reservoir: {}'.format(json.dumps(self.stats())))
+            try:
+                # woken early by take(), otherwise retry anything that failed to refill once its backoff is up
+                await asyncio.wait_for(self.wakeup.wait(), self.retry_delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'refills': self.refills,
+            'refill_failures': self.refill_failures,
+            'average_refill_time': self.refill_time / (self.refills + self.refill_failures or 1),
+            'last_refill_time': self.last_refill_time,
+            'buffered': {u'{}/{}'.format(*key): len(buffered) for key, buffered in self.questions.items()},
+            'backing_off': {u'{}/{}'.format(*key): failures for key, (failures, _) in self.backoff.items()},
+        }
+
+
 class Quote:
     def __init__(self, text, character, movie):
         self.text = text
@@ -108,21 +356,132 @@ class Movie:
         return cls(ser_dict['title'], quotes)
 
 
+class PackedMovie:
+    # stands in for a Movie whose quotes live in the quote pack, only reading them if asked
+    def __init__(self, quote_pack, title):
+        self.quote_pack = quote_pack
+        self.title = title
+        self._quotes = None
+
+    @property
+    def quotes(self):
+        if self._quotes is None:
+            self._quotes = [Quote(text, character, self) for text, character in self.quote_pack.read_quotes(self.title)]
+        return self._quotes
+
+
+class InstrumentedClient(discord.Client):
+    # times every request the bot makes to Discord
+    async def send_message(self, destination, content=None, **kwargs):
+        # goes out through the outbox, returns the sent message once Discord has it
+        return await outbox.send(destination, content, **kwargs)
+
+    async def post_message(self, destination, content=None, **kwargs):
+        # for messages nothing waits on, returns as soon as there's room in the channel's queue. queued
+        # messages are merged with whatever follows them.
+        await outbox.post(destination, content, **kwargs)
+
+    async def send_message_now(self, *args, **kwargs):
+        with metrics.timer('discord.send_message'):
+            return await super().send_message(*args, **kwargs)
+
+    async def send_typing(self, *args, **kwargs):
+        with metrics.timer('discord.send_typing'):
+            return await super().send_typing(*args, **kwargs)
+
+    async def delete_message(self, *args, **kwargs):
+        with metrics.timer('discord.delete_message'):
+            return await super().delete_message(*args, **kwargs)
+
+    async def get_user_info(self, *args, **kwargs):
+        with metrics.timer('discord.get_user_info'):
+            return await super().get_user_info(*args, **kwargs)
+
+
+def get_retry_after(e):
+    # discord.py already waits out and retries a few 429s itself, one that still gets through means back off
+    if isinstance(e, discord.HTTPException) and getattr(e.response, 'status', None) == 429:
+        return OUTBOX_RETRY_AFTER
+    return None
+
+
 ALPHABET = u'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
 GLOBAL_STATE_PATH = 'global_state.json'
+MILLIONAIRE_INDEX_PATH = 'millionaire_index.json'
 QUOTES_DIR = 'movie_quotes'
+QUOTE_PACK_PATH = 'movie_quotes'  # optional, build with `python quote_pack.py build`
 MILLIONAIRE_STATS_DIR = 'millionaire_stats'
 MILLIONAIRE_STATS_EXT = '.mgd'
+MILLIONAIRE_READER = 'mmap'  # see GAME_READERS
+MILLIONAIRE_WORKERS = os.cpu_count() or 1
+MILLIONAIRE_PARALLEL_THRESHOLD = 64  # stale game files before a refresh is spread over the process pool
+MILLIONAIRE_DIFFICULTY_PATH = 'millionaire_difficulty.json'  # optional, build with `python millionaire_analytics.py calibrate`
 TRIVIA_PATH = 'trivia_movies.json'
+GLOBAL_STATE_WRITE_DELAY = 5
+MILLIONAIRE_INDEX_WRITE_DELAY = 30
+TITLE_INDEX_PATH = 'title_index.json'
+TITLE_INDEX_NEGATIVE_TTL = 24 * 60 * 60
+# similarity a local title needs to be taken as a typo of the query without asking IMDb
+TITLE_TYPO_THRESHOLD = 0.8
+QUESTION_BANK_PATH = 'question_bank.sqlite3'
+OPENTDB_CACHE_PATH = 'opentdb_cache.json'
+OPENTDB_CACHE_TTL = 24 * 60 * 60
+NAME_CACHE_PATH = 'discord_names.json'
+NAME_CACHE_TTL = 7 * 24 * 60 * 60
+NAME_LOOKUP_CONCURRENCY = 8
+MOVIE_CACHE_ENTRIES = 512
+MOVIE_CACHE_BYTES = 64 * 1024 * 1024
+METRICS_PATH = 'metrics.jsonl'
+METRICS_INTERVAL = None  # seconds between dumps to METRICS_PATH, None leaves metrics off
+PROFILE_DIR = 'profiles'
+PROFILE_CONTROL_PATH = 'profile.json'  # see CommandProfiler.load_control, delete it to stop profiling
+PROFILE_CONTROL_INTERVAL = 10
+OUTBOX_LIMIT = (5, 5.0)  # sends per channel per seconds
+OUTBOX_GLOBAL_LIMIT = (50, 1.0)  # sends across all channels per seconds
+OUTBOX_MAX_PENDING = 20  # queued messages per channel before send_message waits
+OUTBOX_RETRY_AFTER = 1.0  # seconds a channel backs off when Discord still answers 429
+
+QUESTION_RESERVOIR_LOG_INTERVAL = 60 * 60  # seconds between printing the reservoir's stats, None to never print them
+
+# (difficulty, category) -> (low, high) watermarks for prefetched questions
+QUESTION_RESERVOIR_WATERMARKS = {
+    ('easy', None): (5, 15),
+    ('medium', None): (5, 15),
+    ('hard', None): (4, 12),
+    (None, None): (1, 5),
+}
 
 BADMEME_BOT = discord.User(id=u'170903342199865344')
 TIME_CACHE = TimeCache(60)
 
-NAME_CACHE = {}
-
-client = discord.Client()
+# user id -> MillionaireSummary
+millionaire_index = {}
+# players with at least one game, by each leaderboard ordering. kept in step with millionaire_index.
+millionaire_ranking = Ranking({
+    'total': lambda summary: summary.total_earned,
+    'highest': lambda summary: summary.highest_earned,
+    'games': lambda summary: summary.games_played,
+})
+difficulty_table = DifficultyTable(MILLIONAIRE_DIFFICULTY_PATH)
+# started the first time a refresh needs it, and again after it breaks
+millionaire_pool = None
+
+client = InstrumentedClient()
+outbox = Outbox(client.send_message_now, OUTBOX_LIMIT[0], OUTBOX_LIMIT[1], OUTBOX_GLOBAL_LIMIT[0], OUTBOX_GLOBAL_LIMIT[1],
+                OUTBOX_MAX_PENDING, retry_after=get_retry_after)
 imdb = Imdb()
+opentdb = OpenTDBClient(timeout=5, cache=ResponseCache(OPENTDB_CACHE_PATH, OPENTDB_CACHE_TTL))
+category_index = build_category_index((key, value) for key, value in QUESTION_CATEGORY_MAP.items() if isinstance(key, int))
+question_bank = QuestionBank(QUESTION_BANK_PATH)
 seen_memes = Cache(10)
+game_sessions = SessionManager(TimerWheel())
+movie_cache = MovieCache(MOVIE_CACHE_ENTRIES, MOVIE_CACHE_BYTES)
+title_index = TitleIndex(TITLE_INDEX_PATH, TITLE_INDEX_NEGATIVE_TTL)
+name_cache = NameCache(NAME_CACHE_PATH, NAME_CACHE_TTL)
+name_lookups = asyncio.Semaphore(NAME_LOOKUP_CONCURRENCY)
+# quote file slug -> trigrams, so near misses resolve to a local file before going to IMDb
+title_search = TrigramIndex()
+command_profiler = CommandProfiler(PROFILE_DIR)
 
 global_state = {
     'last_movie': None,
@@ -132,21 +491,46 @@ global_state = {
 }
 
 
-async def get_discord_name(user_id):
-    name = NAME_CACHE.get(user_id, None)
-    if name:
-        return name
-    else:
-        name = str(await client.get_user_info(user_id))
-        NAME_CACHE[user_id] = name
-        return name
+async def lookup_discord_name(user_id):
+    async with name_lookups:
+        try:
+            user = await client.get_user_info(user_id)
+        except discord.HTTPException as e:
+            print('Unable to look up user {}: {}'.format(user_id, e))
+            return
+    name_cache.put(user_id, str(user))
+
 
+async def lookup_discord_names(user_ids):
+    # waits on lookups already in flight rather than starting another
+    lookups = []
+    started = False
+    for user_id in user_ids:
+        lookup = name_cache.pending.get(user_id, None)
+        if lookup is None:
+            lookup = name_cache.pending[user_id] = client.loop.create_task(lookup_discord_name(user_id))
+            lookup.add_done_callback(lambda _, user_id=user_id: name_cache.pending.pop(user_id, None))
+            started = True
+        lookups.append(lookup)
+    if lookups:
+        # asyncio.wait, so a cancelled caller doesn't cancel lookups someone else is waiting on
+        await asyncio.wait(lookups)
+    if started:
+        name_cache.save()
 
-def slugify(value):
-    value = str(unicodedata.normalize('NFKD', value).encode('ascii', 'ignore'), encoding='ascii')
-    value = re.sub(r'[^\w\s-]', '', value).strip().lower()
-    value = re.sub(r'[-\s]+', '-', value)
-    return value
+
+async def get_discord_names(user_ids):
+    # user id -> name. only ids never seen before are waited on, stale names are refreshed in the background.
+    missing = [user_id for user_id in user_ids if name_cache.get(user_id) is None]
+    stale = [user_id for user_id in user_ids if user_id not in missing and name_cache.is_stale(user_id)]
+    if stale:
+        client.loop.create_task(lookup_discord_names(stale))
+    if missing:
+        await lookup_discord_names(missing)
+    return {user_id: name_cache.get(user_id) or user_id for user_id in user_ids}
+
+
+quote_pack = QuotePack.open(QUOTE_PACK_PATH, slugify)
 
 
 def get_movie_filenames():
@@ -156,6 +540,34 @@ def get_movie_filenames():
         return None
 
 
+def load_title_search():
+    for filename in get_movie_filenames() or ():
+        if filename.endswith('.json'):
+            slug = filename[:-len('.json')]
+            title_search.add(slug, slug.replace(u'-', u' '))
+
+
+def search_movie(title):
+    # closest local title, only a guess so it's never written to title_index
+    slug = title_search.best(title)
+    return load_movie(slug + '.json') if slug else None
+
+
+def resolve_typo(title):
+    # a local title close enough to be a typo of this one and naming the same sequel ("Alien 3" is not "Alien")
+    results = title_search.search(title, 1, TITLE_TYPO_THRESHOLD)
+    if results and sequel_tokens(results[0][1]) == sequel_tokens(title):
+        return load_movie(results[0][1] + '.json')
+    return None
+
+
+def no_results_text(title):
+    movie = search_movie(title) if title else None
+    if movie:
+        return u'No results found. Did you mean *{}*?'.format(movie.title)
+    return u'No results found.'
+
+
 def load_movie(title):
     if not title:
         return None
@@ -167,7 +579,12 @@ def load_movie(title):
         filename = slugify(title) + '.json'
         path = os.path.join(QUOTES_DIR, filename)
     try:
-        return Movie.deserialize(json.load(open(path, 'r', encoding='utf-8')))
+        stat = movie_cache.stat(path)
+        movie = movie_cache.get(path, stat)
+        if not movie:
+            movie = Movie.deserialize(json.load(open(path, 'r', encoding='utf-8')))
+            movie_cache.put(path, stat, movie)
+        return movie
     except IOError:
         return None
 
@@ -179,7 +596,12 @@ def save_movie(movie):
         pass
     filename = slugify(movie.title) + '.json'
     path = os.path.join(QUOTES_DIR, filename)
-    json.dump(movie.serialize(), open(path, 'w', encoding='utf-8'))
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(movie.serialize(), f)
+    movie_cache.put(path, movie_cache.stat(path), movie)
+    title_search.add(slugify(movie.title), movie.title)
+    if quote_pack:
+        quote_pack.append(movie.title, [(quote.text, quote.character) for quote in movie.quotes])
 
 
 def extract_quote(quote):
@@ -213,28 +635,60 @@ def get_movie(movie_title):
         return None
     movie = load_movie(movie_title)
     if not movie:
-        results = imdb.search_for_title(movie_title)
+        query = movie_title
+        movie = load_movie(title_index.get(query))
+        if movie or title_index.is_missing(query):
+            return movie
+        movie = resolve_typo(query)
+        if movie:
+            title_index.add(query, movie.title)
+            return movie
+        try:
+            with metrics.timer('imdb.search_for_title'):
+                results = imdb.search_for_title(query)
+        except requests.RequestException as e:
+            print('Unable to search IMDb for "{}", falling back to the closest local title: {}'.format(query, e))
+            return search_movie(query)
         if results:
             result = results[0]
             movie_title = result['title']
             movie = load_movie(movie_title)
             if not movie:
                 try:
-                    quote_results = imdb.get_title_quotes(result['imdb_id'])['quotes']
+                    with metrics.timer('imdb.get_title_quotes'):
+                        quote_results = imdb.get_title_quotes(result['imdb_id'])['quotes']
                     movie = [extract_quote(movie['lines']) for movie in quote_results if count_lines(movie['lines']) <= 1]
                     movie = Movie(movie_title, [quote for quote in movie if quote])
                     save_movie(movie)
                 except LookupError:
                     movie = None
+        if movie:
+            title_index.add(query, movie.title)
+        else:
+            title_index.add_missing(query)
     return movie
 
 
+def remember_quote(quote):
+    global_state['last_character'] = quote.character
+    global_state['last_movie'] = quote.movie
+    save_global_state()
+
+
 def get_quote(movie):
     if movie.quotes:
         quote = random.choice(movie.quotes)
-        global_state['last_character'] = quote.character
-        global_state['last_movie'] = movie
-        save_global_state()
+        remember_quote(quote)
+        return quote
+    return None
+
+
+def get_packed_quote(title=None):
+    packed_quote = quote_pack.random_quote(title)
+    if packed_quote:
+        title, text, character = packed_quote
+        quote = Quote(text, character, PackedMovie(quote_pack, title))
+        remember_quote(quote)
         return quote
     return None
 
@@ -247,28 +701,44 @@ def count_lines(quote):
     return count
 
 
-def get_session_token():
-    url = 'https://opentdb.com/api_token.php?command=request'
-    response = requests.get(url).json()
+async def get_session_token():
+    try:
+        response = await opentdb.get_session_token()
+    except (requests.RequestException, ValueError) as e:
+        print('Unable to get session token: {}'.format(e))
+        return None
     if response[u'response_code'] == 0:
         return response[u'token']
     return None
 
 
-def get_questions(amount, category=None, difficulty=None, session_token=None):
+def get_category_name(category):
+    try:
+        return QUESTION_CATEGORY_MAP.get(int(category), None)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_bank_questions(amount, category=None, difficulty=None):
+    category_name = get_category_name(category)
+    if category and not category_name:
+        return None
+    return question_bank.sample(amount, category_name, difficulty)
+
+
+async def get_questions(amount, category=None, difficulty=None, session_token=None):
     if not session_token:
         session_token = global_state['trivia_token']
     if not session_token:
-        session_token = get_session_token()
+        session_token = await get_session_token()
         if session_token:
             global_state['trivia_token'] = session_token
             save_global_state()
-    url = 'https://opentdb.com/api.php?amount={}&type=multiple{}{}{}'.format(
-        amount,
-        '&category={}'.format(category) if category else '',
-        '&difficulty={}'.format(difficulty) if difficulty else '',
-        '&token={}'.format(session_token) if session_token else '')
-    response = requests.get(url).json()
+    try:
+        response = await opentdb.get_questions(amount, category, difficulty, session_token)
+    except (requests.RequestException, ValueError) as e:
+        print('Unable to get questions, falling back to the question bank: {}'.format(e))
+        return get_bank_questions(amount, category, difficulty)
 
     # Code 0: Success Returned results successfully.
     # Code 1: No Results Could not return results. The API doesn't have enough questions for your query. (Ex. Asking for 50 Questions in a Category that only has 20.)
@@ -277,22 +747,33 @@ def get_questions(amount, category=None, difficulty=None, session_token=None):
     # Code 4: Token Empty Session Token has returned all possible questions for the specified query. Resetting the Token is necessary.
 
     if response[u'response_code'] == 0:
-        return [Question.deserialize(question) for question in response[u'results']]
+        questions = [Question.deserialize(question) for question in response[u'results']]
+        question_bank.add(questions)
+        return questions
     elif response[u'response_code'] in (3, 4):
-        session_token = get_session_token()
+        session_token = await get_session_token()
         if session_token:
-            return get_questions(amount, category, difficulty, session_token)
+            return await get_questions(amount, category, difficulty, session_token)
         else:
             # can't get new session token, invalidate old session token
             global_state['trivia_token'] = None
             save_global_state()
-    return None
+    return get_bank_questions(amount, category, difficulty)
 
 
-def get_categories():
-    url = 'https://opentdb.com/api_category.php'
-    response = requests.get(url).json()
-    return [(category[u'id'], category[u'name']) for category in response[u'trivia_categories']]
+async def get_categories():
+    try:
+        response = await opentdb.get_categories()
+        categories = [(category[u'id'], category[u'name']) for category in response[u'trivia_categories']]
+    except (requests.RequestException, ValueError, KeyError, TypeError) as e:
+        print('Unable to get categories, falling back to the known list: {}'.format(e))
+        return sorted((key, value) for key, value in QUESTION_CATEGORY_MAP.items() if isinstance(key, int))
+    # pick up any categories added since QUESTION_CATEGORY_MAP was written
+    category_index.update(build_category_index(categories))
+    return categories
+
+
+question_reservoir = QuestionReservoir(get_questions, QUESTION_RESERVOIR_WATERMARKS, log_interval=QUESTION_RESERVOIR_LOG_INTERVAL)
 
 
 def how_long(seconds):
@@ -326,51 +807,190 @@ def load_global_state():
     global_state.update(state)
 
 
-def save_global_state():
+def write_global_state():
     state = dict(global_state)
     if state['last_movie']:
         state['last_movie'] = global_state['last_movie'].title
-    json.dump(state, open(GLOBAL_STATE_PATH, 'w', encoding='utf-8'))
+    atomic_write_json(GLOBAL_STATE_PATH, state)
+
+
+global_state_writer = WriteBehind(write_global_state, GLOBAL_STATE_WRITE_DELAY)
+
+
+def save_global_state():
+    global_state_writer.mark_dirty()
 
 
 def get_millionaire_game_filenames():
-    return next(os.walk(MILLIONAIRE_STATS_DIR))[2]
+    return [filename for filename in next(os.walk(MILLIONAIRE_STATS_DIR))[2] if filename.endswith(MILLIONAIRE_STATS_EXT)]
 
 
-def load_millionaire_games(user_id):
+def get_millionaire_game_path(user_id):
     if isinstance(user_id, str) and user_id.endswith(MILLIONAIRE_STATS_EXT):
         if user_id.startswith(MILLIONAIRE_STATS_DIR):
-            path = user_id
+            return user_id
         else:
-            path = os.path.join(MILLIONAIRE_STATS_DIR, user_id)
+            return os.path.join(MILLIONAIRE_STATS_DIR, user_id)
     else:
-        path = os.path.join(MILLIONAIRE_STATS_DIR, '{}{}'.format(user_id, MILLIONAIRE_STATS_EXT))
+        return os.path.join(MILLIONAIRE_STATS_DIR, '{}{}'.format(user_id, MILLIONAIRE_STATS_EXT))
+
+
+def load_millionaire_games(user_id, reader=MILLIONAIRE_READER):
+    path = get_millionaire_game_path(user_id)
     try:
-        file_size = os.path.getsize(path)
-        with open(path, 'rb') as read_byte_stream:
-            while read_byte_stream.tell() < file_size:
-                yield MillionaireGame.read(read_byte_stream)
+        for game, _ in GAME_READERS[reader](path, recover=True):
+            yield game
     except FileNotFoundError:
         return None
 
 
-def save_millionaire_game(game):
-    temp_ext = '.temp'
-    path = os.path.join(MILLIONAIRE_STATS_DIR, '{}{}'.format(game.user, MILLIONAIRE_STATS_EXT))
-    temp_path = path + temp_ext
-    with open(temp_path, 'wb') as write_byte_stream:
-        try:
-            with open(path, 'rb') as read_byte_stream:
-                write_byte_stream.write(read_byte_stream.read())
-        except FileNotFoundError:
-            pass
-        game.write(write_byte_stream)
-    os.replace(temp_path, path)
+def save_millionaire_game(game, fsync=False):
+    path = get_millionaire_game_path(game.user)
+    upgrade_games(path)
+    # the summary covers every intact record, so anything past it is a torn write
+    update_millionaire_summary(game.user)
+    summary = millionaire_index[game.user]
+    if os.path.getsize(path) > summary.offset:
+        truncate_games(path, summary.offset)
+    append_game(path, game, fsync)
+    update_millionaire_summary(game.user)
+    save_millionaire_index()
+
+
+def load_millionaire_index():
+    try:
+        index = json.load(open(MILLIONAIRE_INDEX_PATH, 'r', encoding='utf-8'))
+    except IOError:
+        return
+    for user, summary in index.items():
+        set_millionaire_summary(user, MillionaireSummary.deserialize(summary))
+
+
+def write_millionaire_index():
+    atomic_write_json(MILLIONAIRE_INDEX_PATH, {user: summary.serialize() for user, summary in millionaire_index.items()})
+
+
+# losing the last few seconds of it is harmless, a summary behind its game file is refreshed before the next leaderboard
+millionaire_index_writer = WriteBehind(write_millionaire_index, MILLIONAIRE_INDEX_WRITE_DELAY)
+
+
+def save_millionaire_index():
+    millionaire_index_writer.mark_dirty()
+
+
+def set_millionaire_summary(user_id, summary):
+    if summary is None:
+        millionaire_index.pop(user_id, None)
+        millionaire_ranking.remove(user_id)
+        return
+    millionaire_index[user_id] = summary
+    if summary.games_played:
+        millionaire_ranking.update(user_id, summary)
+    else:
+        millionaire_ranking.remove(user_id)
+
+
+def update_millionaire_summary(user_id):
+    # only decodes the games appended since the summary was last updated
+    summary = millionaire_index.get(user_id, None)
+    offset = summary.offset if summary else None
+    try:
+        summary = summarize_games(get_millionaire_game_path(user_id), summary, MILLIONAIRE_READER)
+    except FileNotFoundError:
+        changed = user_id in millionaire_index
+        set_millionaire_summary(user_id, None)
+        return changed
+    set_millionaire_summary(user_id, summary)
+    return summary.offset != offset
+
+
+def get_stale_millionaire_users():
+    # users whose game file has changed size since their summary was taken
+    stale = []
+    for user_filename in get_millionaire_game_filenames():
+        user_id = user_filename[:-len(MILLIONAIRE_STATS_EXT)]
+        summary = millionaire_index.get(user_id, None)
+        if not summary or os.path.getsize(get_millionaire_game_path(user_id)) != summary.offset:
+            stale.append(user_id)
+    return stale
+
+
+def refresh_millionaire_index(stale=None):
+    changed = False
+    for user_id in get_stale_millionaire_users() if stale is None else stale:
+        changed = update_millionaire_summary(user_id) or changed
+    if changed:
+        save_millionaire_index()
+
+
+def get_millionaire_pool():
+    global millionaire_pool
+    if millionaire_pool is None:
+        # summarize_game_files lives in millionaire_stats, which is all the workers need
+        millionaire_pool = create_worker_pool(MILLIONAIRE_WORKERS)
+    return millionaire_pool
+
+
+async def rebuild_millionaire_index():
+    # same as refresh_millionaire_index, but with enough stale files they're decoded on the process pool
+    # while the event loop keeps serving
+    global millionaire_pool
+    stale = get_stale_millionaire_users()
+    if len(stale) < MILLIONAIRE_PARALLEL_THRESHOLD:
+        refresh_millionaire_index(stale)
+        return
+    jobs = [(get_millionaire_game_path(user_id), millionaire_index.get(user_id, None)) for user_id in stale]
+    offsets = [summary.offset if summary else None for _, summary in jobs]
+    chunk_size = max([1, len(jobs) // (MILLIONAIRE_WORKERS * 4)])
+    loop = asyncio.get_event_loop()
+    pool = get_millionaire_pool()
+    try:
+        results = await asyncio.gather(*[loop.run_in_executor(pool, summarize_game_files, jobs[start:start + chunk_size], MILLIONAIRE_READER)
+                                         for start in range(0, len(jobs), chunk_size)])
+    except BrokenProcessPool as e:
+        print('Millionaire process pool failed, refreshing in process: {}'.format(e))
+        # the next rebuild starts a new pool
+        if millionaire_pool is pool:
+            millionaire_pool = None
+        pool.shutdown(wait=False)
+        refresh_millionaire_index()
+        return
+    for user_id, offset, summary in zip(stale, offsets, chain.from_iterable(results)):
+        # a game saved while the pool was busy already moved this user's summary past what it decoded
+        current = millionaire_index.get(user_id, None)
+        if (current.offset if current else None) != offset:
+            continue
+        set_millionaire_summary(user_id, summary)
+    save_millionaire_index()
+
+
+async def import_millionaire_questions():
+    # decoding old history can take a while, so it runs off the event loop. only the inserts happen here.
+    questions = await client.loop.run_in_executor(None, read_millionaire_history, MILLIONAIRE_STATS_DIR)
+    added = import_millionaire_history(question_bank, MILLIONAIRE_STATS_DIR, questions=questions)
+    print('Imported {} questions from Millionaire history.'.format(added))
 
 
 @client.event
 async def on_ready():
     load_global_state()
+    load_title_search()
+    load_millionaire_index()
+    # refresh known players' names in the background so the first leaderboard doesn't have to
+    client.loop.create_task(lookup_discord_names([summary.user for summary in millionaire_index.values()
+                                                  if summary.games_played and name_cache.is_stale(summary.user)]))
+    if not question_bank.has_imported(MILLIONAIRE_HISTORY_IMPORT):
+        client.loop.create_task(import_millionaire_questions())
+    question_reservoir.start(client.loop)
+    game_sessions.timers.start(client.loop)
+    command_profiler.watch(client.loop, PROFILE_CONTROL_PATH, PROFILE_CONTROL_INTERVAL)
+    if METRICS_INTERVAL:
+        metrics.add_source('question_reservoir', question_reservoir.stats)
+        metrics.add_source('movie_cache', movie_cache.stats)
+        metrics.add_source('global_state_writer', global_state_writer.stats)
+        metrics.add_source('millionaire_index_writer', millionaire_index_writer.stats)
+        metrics.add_source('outbox', outbox.stats)
+        metrics.start(client.loop, METRICS_PATH, METRICS_INTERVAL)
     print('Logged in as')
     print(client.user.name)
     print(client.user.id)
@@ -378,15 +998,44 @@ async def on_ready():
 
 
 COMMANDS = []
-def command(command_string, description, usage=None):
+COMMAND_ALIASES = []
+def command(command_string, description, usage=None, aliases=()):
     def decorator(func):
-        COMMANDS.append((command_string, func, description, usage))
+        wrapped_func = metrics.timed(u'command ' + command_string)(command_profiler.wrap(command_string, func))
+        COMMANDS.append((command_string, wrapped_func, description, usage))
+        COMMAND_ALIASES.extend((alias, wrapped_func) for alias in aliases)
         return func
     return decorator
 
 
+def game(name):
+    # one game per channel. the game gets its session as a third argument, and can hand it to another game.
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(message, rest, session=None):
+            if session:
+                session.name = name
+                return await func(message, rest, session)
+            session = game_sessions.open(message.channel.id, name)
+            if not session:
+                await client.send_message(message.channel, u'_{}_ is already being played here.'.format(game_sessions.get(message.channel.id).name))
+                return
+            try:
+                return await func(message, rest, session)
+            finally:
+                game_sessions.close(session)
+        return wrapper
+    return decorator
+
+
 @command(u'!quote', u'Get a random quote.', usage=u'!quote [title]')
 async def quote_command(message, rest):
+    if quote_pack:
+        quote = get_packed_quote(rest.strip() or None)
+        if quote:
+            await client.send_message(message.channel, u'"{}"'.format(quote.text))
+            return
+
     if rest:
         movie = get_movie(rest)
     else:
@@ -403,7 +1052,7 @@ async def quote_command(message, rest):
         else:
             await client.send_message(message.channel, u'No quotes available for "{}".'.format(movie.text))
     else:
-        await client.send_message(message.channel, u'No results found.')
+        await client.send_message(message.channel, no_results_text(rest))
 
 
 @command(u'!title', u'Get the title that the last quote was from.')
@@ -447,7 +1096,7 @@ async def qtrivia_add_command(message, rest):
             save_trivia_movies(movies)
             await client.send_message(message.channel, u'Added *{}* to trivia.'.format(movie.title))
     else:
-        await client.send_message(message.channel, u'No results found.')
+        await client.send_message(message.channel, no_results_text(rest))
 
 
 @command(u'!qtrivia clear', u'Clear the quote trivia list.')
@@ -468,7 +1117,15 @@ async def qtrivia_remove_command(message, rest):
                 await client.send_message(message.channel, u'*{}* removed from trivia.'.format(removed_title))
                 break
         else:
-            await client.send_message(message.channel, u'No matches for title "{}".'.format(movie_title_slug))
+            # only ever removes an exact match, a near miss is just suggested
+            trivia_search = TrigramIndex()
+            for index, trivia_movie_title in enumerate(trivia_movie_titles):
+                trivia_search.add(index, trivia_movie_title)
+            index = trivia_search.best(rest)
+            if index is not None:
+                await client.send_message(message.channel, u'No matches for title "{}". Did you mean *{}*?'.format(movie_title_slug, trivia_movie_titles[index]))
+            else:
+                await client.send_message(message.channel, u'No matches for title "{}".'.format(movie_title_slug))
 
 
 @command(u'!qtrivia list', u'List the titles currently in the quote trivia list.')
@@ -481,7 +1138,8 @@ async def qtrivia_list_command(message, rest):
 
 
 @command(u'!qtrivia', u'Play quote trivia.', usage=u'!qtrivia [<amount> [title]]')
-async def qtrivia_command(message, rest):
+@game(u'Quote Trivia')
+async def qtrivia_command(message, rest, session):
     movie_lock = None
     count = 1
 
@@ -514,24 +1172,26 @@ async def qtrivia_command(message, rest):
         await client.send_message(message.channel, u'**{}_{}_**\n"{}"'.format(prefix, quote.movie.title, quote.text))
         question_number += 1
 
+        matcher = AnswerMatcher(quote.character)
+
         def check(msg):
-            return msg.author != client.user and (msg.content.startswith(u'!stop') or (slugify(quote.character.strip()) in slugify(msg.content.strip())))
+            return msg.author != client.user and (msg.content.startswith(u'!stop') or matcher.match(msg.content))
         
-        response = await client.wait_for_message(timeout=30, channel=message.channel, check=check)
+        response = await session.wait_for_message(check, timeout=30)
 
         if response:
             if response.content.startswith(u'!stop'):
-                await client.send_message(message.channel, u'k.')
+                await client.post_message(message.channel, u'k.')
                 break
             else:
-                await client.send_message(message.channel, u'{} got it. **{}** - *{}*.'.format(response.author, quote.character, quote.movie.title))
+                await client.post_message(message.channel, u'{} got it. **{}** - *{}*.'.format(response.author, quote.character, quote.movie.title))
                 scores[response.author] = scores.get(response.author, 0) + 1
 
         else:
-            await client.send_message(message.channel, u'Noobs. **{}** - *{}*.'.format(quote.character, quote.movie.title))
+            await client.post_message(message.channel, u'Noobs. **{}** - *{}*.'.format(quote.character, quote.movie.title))
 
     if scores and count > 1:
-        await client.send_message(message.channel, u', '.join([u'{}: {}'.format(name, score) for name, score in scores.items()]))
+        await client.post_message(message.channel, u', '.join([u'{}: {}'.format(name, score) for name, score in scores.items()]))
 
 
 @command(u'!count', u'Get the amount of quotes a title has.', usage=u'!count <title>')
@@ -540,17 +1200,18 @@ async def count_command(message, rest):
     if movie:
         await client.send_message(message.channel, u'*{}* has **{}** quotes.'.format(movie.title, len(movie.quotes)))
     else:
-        await client.send_message(message.channel, u'No results found.')
+        await client.send_message(message.channel, no_results_text(rest))
 
 
-@command(u'!help', u'List all commands associated with the bot.')
+@command(u'!help', u'List all commands associated with the bot.', aliases=[u'!commands'])
 async def help_command(message, rest):
     command_descriptions = [u'**`{}`** - *{}*'.format(usage or command_text, description) for command_text, _, description, usage in COMMANDS]
     await client.send_message(message.channel, u'\n'.join(command_descriptions))
 
 
 @command(u'!trivia', u'Play trivia.', usage=u'!trivia [<amount> [category]]')
-async def trivia_command(message, rest):
+@game(u'Trivia')
+async def trivia_command(message, rest, session):
     category = None
     amount = 1
 
@@ -562,9 +1223,17 @@ async def trivia_command(message, rest):
     except:
         pass
 
-    questions = get_questions(amount, category)
+    if category:
+        category_id = resolve_category(category_index, category)
+        if category_id is None:
+            await client.send_message(message.channel, u'Unknown category "{}". See `!categories`.'.format(category))
+            return
+        category = category_id
+
+    questions = await question_reservoir.take(amount, category=category)
     if not questions:
         await client.send_message(message.channel, u'Unable to retrieve questions.')
+        return
 
     scores = {}
     for question_number, question in enumerate(questions):
@@ -584,30 +1253,31 @@ async def trivia_command(message, rest):
                 return True
             return False
         
-        response = await client.wait_for_message(timeout=30, channel=message.channel, check=check)
+        response = await session.wait_for_message(check, timeout=30)
 
         if response:
             if response.content.startswith(u'!stop'):
-                await client.send_message(message.channel, u'k.')
+                await client.post_message(message.channel, u'k.')
                 break
             else:
                 if answer_key[response.content[0].upper()] == question.correct_answer:
-                    await client.send_message(message.channel, u'{} got it. **{}**.'.format(response.author, question.correct_answer))
+                    await client.post_message(message.channel, u'{} got it. **{}**.'.format(response.author, question.correct_answer))
                     scores[response.author] = scores.get(response.author, 0) + 1
                 else:
-                    await client.send_message(message.channel, u'Wrong. **{}**.'.format(question.correct_answer))
+                    await client.post_message(message.channel, u'Wrong. **{}**.'.format(question.correct_answer))
         else:
-            await client.send_message(message.channel, u'Noobs. **{}**.'.format(question.correct_answer))
+            await client.post_message(message.channel, u'Noobs. **{}**.'.format(question.correct_answer))
         await asyncio.sleep(2)
 
     if scores and amount > 1:
-        await client.send_message(message.channel, u', '.join([u'{}: {}'.format(name, score) for name, score in scores.items()]))
+        await client.post_message(message.channel, u', '.join([u'{}: {}'.format(name, score) for name, score in scores.items()]))
 
 
 @command(u'!millionaire', u'Play _Who Wants to be a Millionaire!_')
-async def millionaire_command(message, rest):
+@game(u'Who Wants to be a Millionaire!')
+async def millionaire_command(message, rest, session):
     player = message.author
-    await client.send_message(message.channel, u'**{}, welcome to _Who Wants to be a Millionaire!_**'.format(player))
+    await client.post_message(message.channel, u'**{}, welcome to _Who Wants to be a Millionaire!_**'.format(player))
     await client.send_typing(message.channel)
 
     dollar_amounts = [500,
@@ -638,15 +1308,18 @@ async def millionaire_command(message, rest):
     for amount, difficulty in question_sets:
         diff_questions = None
         for attempt in range(3):
-            diff_questions = get_questions(amount, difficulty=difficulty)
+            diff_questions = await question_reservoir.take(amount, difficulty=difficulty)
             if diff_questions:
                 break
-            await client.send_message(message.channel, u'Unable to retrieve questions, please wait... ({}/3)'.format(attempt + 1))
+            await client.post_message(message.channel, u'Unable to retrieve questions, please wait... ({}/3)'.format(attempt + 1))
             await asyncio.sleep(10)
         else:
             await client.send_message(message.channel, u'Unable to generate game. Try again later.')
             return
         questions.extend(diff_questions)
+    difficulty_table.refresh()
+    if difficulty_table:
+        questions = difficulty_table.order(questions)
 
     if player.voice:
         try:
@@ -700,7 +1373,7 @@ async def millionaire_command(message, rest):
         continuing = True
         while continuing:
             continuing = False
-            response = await client.wait_for_message(timeout=120, channel=message.channel, check=check)
+            response = await session.wait_for_message(check, timeout=120)
             if response:
                 given_answer = answer_key.get(response.content[0].upper(), None)
                 lower_msg = response.content.lower()
@@ -716,104 +1389,139 @@ async def millionaire_command(message, rest):
                 elif lower_msg.startswith(lifeline_key[Lifeline.DoubleDip]):
                     lifelines ^= Lifeline.DoubleDip
                     lifelines_used |= Lifeline.DoubleDip
-                    response = await client.wait_for_message(timeout=120, channel=message.channel, check=check)
+                    response = await session.wait_for_message(check, timeout=120)
                     if response:
                         given_answer = answer_key.get(response.content[0].upper(), None)
                         if given_answer == question.correct_answer:
-                            await client.send_message(message.channel, u'**THAT IS CORRECT.**')
+                            await client.post_message(message.channel, u'**THAT IS CORRECT.**')
                             if question_amount in checkpoints:
                                 score = question_amount
                             walk_away_amount = question_amount
                             stats_round.given_answer = given_answer
                         else:
-                            await client.send_message(message.channel, u"I'm sorry... that is incorrect. You have one more shot at the prize.")
+                            await client.post_message(message.channel, u"I'm sorry... that is incorrect. You have one more shot at the prize.")
                             answer_key.pop(response.content[0].upper())
                             await client.send_message(message.channel, u'**Remaining answers:**\n{}'.format(answer_key_text()))
-                            response = await client.wait_for_message(timeout=120, channel=message.channel, check=check)
+                            response = await session.wait_for_message(check, timeout=120)
                             if response:
                                 given_answer = answer_key.get(response.content[0].upper(), None)
                                 if given_answer == question.correct_answer:
-                                    await client.send_message(message.channel, u'**THAT IS CORRECT.**')
+                                    await client.post_message(message.channel, u'**THAT IS CORRECT.**')
                                     stats_round.given_answer = given_answer
                                     if question_amount in checkpoints:
                                         score = question_amount
                                     walk_away_amount = question_amount
                                 else:
-                                    await client.send_message(message.channel, u'Wrong. The correct answer was **{}**.'.format(question.correct_answer))
+                                    await client.post_message(message.channel, u'Wrong. The correct answer was **{}**.'.format(question.correct_answer))
                                     stats_round.given_answer = given_answer
                                     game_over = True
                             else:
-                                await client.send_message(message.channel, u'Time is up. The correct answer was **{}**.'.format(question.correct_answer))
+                                await client.post_message(message.channel, u'Time is up. The correct answer was **{}**.'.format(question.correct_answer))
                                 stats_round.time_up = True
                                 game_over = True
                     else:
-                        await client.send_message(message.channel, u'Time is up. The correct answer was **{}**.'.format(question.correct_answer))
+                        await client.post_message(message.channel, u'Time is up. The correct answer was **{}**.'.format(question.correct_answer))
                         stats_round.time_up = True
                         game_over = True
                 elif lower_msg.startswith(u'!walk'):
                     score = walk_away_amount
-                    await client.send_message(message.channel, u'I respect that. The correct answer was **{}** by the way.'.format(question.correct_answer))
+                    await client.post_message(message.channel, u'I respect that. The correct answer was **{}** by the way.'.format(question.correct_answer))
                     game_over = True
                 elif given_answer == question.correct_answer:
-                    await client.send_message(message.channel, u'**THAT IS CORRECT.**')
+                    await client.post_message(message.channel, u'**THAT IS CORRECT.**')
                     stats_round.given_answer = given_answer
                     if question_amount in checkpoints:
                         score = question_amount
                     walk_away_amount = question_amount
                 else:
-                    await client.send_message(message.channel, u'Wrong. The correct answer was **{}**.'.format(question.correct_answer))
+                    await client.post_message(message.channel, u'Wrong. The correct answer was **{}**.'.format(question.correct_answer))
                     stats_round.given_answer = given_answer
                     game_over = True
             else:
-                await client.send_message(message.channel, u'Time is up. The correct answer was **{}**.'.format(question.correct_answer))
+                await client.post_message(message.channel, u'Time is up. The correct answer was **{}**.'.format(question.correct_answer))
                 stats_round.time_up = True
                 game_over = True
         stats_round.lifelines_used = lifelines_used
         stats.rounds.append(stats_round)
-    await client.send_message(message.channel, u'{} walks away with ${:,}.'.format(player, score))
+    await client.post_message(message.channel, u'{} walks away with ${:,}.'.format(player, score))
     stats.amount_earned = score
     save_millionaire_game(stats)
 
 
-@command(u'!leaderboard', u'Display _Who Wants to be a Millionaire!_ leaderboard.')
+LEADERBOARD_PAGE_SIZE = 10
+# millionaire_ranking ordering -> column title
+LEADERBOARD_ORDERINGS = OrderedDict([
+    (u'total', u'Total Earnings'),
+    (u'highest', u'Highest Score'),
+    (u'games', u'Games Played'),
+])
+LEADERBOARD_ALIASES = {
+    u'earnings': u'total',
+    u'earned': u'total',
+    u'high': u'highest',
+    u'best': u'highest',
+    u'played': u'games',
+}
+
+
+async def refresh_millionaire_ranking():
+    # saves keep the ranking current, this only picks up files changed behind the bot's back
+    if TIME_CACHE.get('millionaire_index', None) is None:
+        await rebuild_millionaire_index()
+        TIME_CACHE['millionaire_index'] = True
+
+
+@command(u'!leaderboard', u'Display _Who Wants to be a Millionaire!_ leaderboard.', usage=u'!leaderboard [total|highest|games] [page]', aliases=[u'!lb'])
 async def leaderboard_command(message, rest):
-    leaderboard = TIME_CACHE.get('leaderboard', None)
-    format_str = u'`{:<20}{:>19}{:>18}{:>17}`'
-    if not leaderboard:
-        await client.send_typing(message.channel)
-        start = time.time()
-        player_scores = []
-        # Name, Total Earnings, Highest Score, Games Played
-        for user_filename in get_millionaire_game_filenames():
-            name = None
-            highest_earned = 0
-            total_earned = 0
-            count = 0
-            for game in load_millionaire_games(user_filename):
-                if not name:
-                    name = await get_discord_name(game.user)
-                total_earned += game.amount_earned
-                highest_earned = max([highest_earned, game.amount_earned])
-                count += 1
-                if (count % 5000) == 0:
-                    await client.send_typing(message.channel)
-            if name:
-                player_scores.append((name, total_earned, highest_earned, count))
-        player_scores.sort(key=lambda item: item[1], reverse=True) # sort by total earned
-        leaderboard_builder = [format_str.format(name, int_to_dollars(total_earned), int_to_dollars(highest_earned), count) for name, total_earned, highest_earned, count in player_scores]
-        leaderboard_builder.insert(0, u'**' + format_str.format(u'Name', u'Total Earnings', u'Highest Score', u'Games Played') + u'**')
-        leaderboard = u'\n'.join(leaderboard_builder)
-        updated_str = u'\n*(Generated in {:.2f} seconds)*'.format(time.time() - start)
-        TIME_CACHE['leaderboard'] = leaderboard
-    else:
-        updated_str = u'\n*(Last updated {} ago)*'.format(how_long(TIME_CACHE.age('leaderboard')))
-    await client.send_message(message.channel, leaderboard + updated_str)
+    ordering = u'total'
+    page = 1
+    for arg in rest.lower().split():
+        if arg.isdigit():
+            page = max([1, int(arg)])
+        elif arg in LEADERBOARD_ORDERINGS or arg in LEADERBOARD_ALIASES:
+            ordering = LEADERBOARD_ALIASES.get(arg, arg)
+        else:
+            await client.send_message(message.channel, u'Unknown leaderboard "{}", try one of: {}.'.format(arg, u', '.join(LEADERBOARD_ORDERINGS)))
+            return
+    await refresh_millionaire_ranking()
+    pages = max([1, -(-len(millionaire_ranking) // LEADERBOARD_PAGE_SIZE)])
+    page = min([page, pages])
+    start = (page - 1) * LEADERBOARD_PAGE_SIZE
+    players = millionaire_ranking.top(ordering, LEADERBOARD_PAGE_SIZE, start)
+    names = await get_discord_names([user_id for user_id, _ in players])
+    format_str = u'`{:>4} {:<20}{:>19}{:>18}{:>17}`'
+    leaderboard_builder = [u'**' + format_str.format(u'#', u'Name', u'Total Earnings', u'Highest Score', u'Games Played') + u'**']
+    for user_id, _ in players:
+        summary = millionaire_index[user_id]
+        leaderboard_builder.append(format_str.format(millionaire_ranking.rank(ordering, user_id), names[user_id],
+                                                     int_to_dollars(summary.total_earned), int_to_dollars(summary.highest_earned), summary.games_played))
+    leaderboard_builder.append(u'*(By {}, page {} of {})*'.format(LEADERBOARD_ORDERINGS[ordering].lower(), page, pages))
+    await client.send_message(message.channel, u'\n'.join(leaderboard_builder))
+
+
+@command(u'!rank', u'Show where a player stands on each _Millionaire!_ leaderboard.', usage=u'!rank [@user]')
+async def rank_command(message, rest):
+    player = message.mentions[0] if message.mentions else message.author
+    await refresh_millionaire_ranking()
+    if player.id not in millionaire_ranking:
+        await client.send_message(message.channel, u'{} has not played _Millionaire!_ yet.'.format(player))
+        return
+    summary = millionaire_index[player.id]
+    values = {
+        u'total': int_to_dollars(summary.total_earned),
+        u'highest': int_to_dollars(summary.highest_earned),
+        u'games': u'{:,}'.format(summary.games_played),
+    }
+    ranks = [u'**#{}** by {} ({})'.format(millionaire_ranking.rank(ordering, player.id), title.lower(), values[ordering])
+             for ordering, title in LEADERBOARD_ORDERINGS.items()]
+    await client.send_message(message.channel, u'{} ranks {} out of {:,} players.'.format(player, u', '.join(ranks), len(millionaire_ranking)))
 
 
 @command(u'!fff', u'Play _Fastest Finger First_ to determine who gets to play _Millionaire!_')
-async def fff_command(message, rest):
+@game(u'Fastest Finger First')
+async def fff_command(message, rest, session):
     await client.send_typing(message.channel)
-    question = get_questions(1)
+    question = await question_reservoir.take(1)
     if question:
         question = question[0]
         
@@ -840,19 +1548,19 @@ async def fff_command(message, rest):
                     answered.add(msg.author)
             return False
         
-        response = await client.wait_for_message(timeout=30, channel=message.channel, check=check)
+        response = await session.wait_for_message(check, timeout=30)
 
         if response:
-            await millionaire_command(response, '')
+            await millionaire_command(response, '', session)
         else:
-            await client.send_message(message.channel, u'Time is up. The correct answer was **{}**.'.format(question.correct_answer))
+            await client.post_message(message.channel, u'Time is up. The correct answer was **{}**.'.format(question.correct_answer))
     else:
         await client.send_message(message.channel, u'Unable to retrieve question.')
 
 
 @command(u'!categories', u'List all available trivia categories.')
 async def categories_command(message, rest):
-    categories = get_categories()
+    categories = await get_categories()
     category_text = u'\n'.join(['**{}**: *{}*'.format(id, name) for id, name in categories])
     await client.send_message(message.channel, category_text)
 
@@ -873,13 +1581,20 @@ async def badmeme_bot_command(message, rest):
             seen_memes.push(response.content)
 
 
+# every command is registered by now
+command_dispatcher = CommandDispatcher([(command_text, func) for command_text, func, *_ in COMMANDS] + COMMAND_ALIASES)
+
+
 @client.event
 async def on_message(message):
     if message.author != client.user:
-        for command_text, func, *_ in COMMANDS:
-            if message.content.startswith(command_text):
-                await func(message, message.content[len(command_text):])
-                break
+        # games only ever wait on text
+        if message.content:
+            game_sessions.route(message.channel.id, message)
+        match = command_dispatcher.match(message.content)
+        if match:
+            command_text, func = match
+            await func(message, message.content[len(command_text):])
 
 
 def main():
@@ -888,7 +1603,13 @@ def main():
     except IOError:
         pass
     if token:
-        client.run(token)
+        try:
+            client.run(token)
+        finally:
+            global_state_writer.flush()
+            millionaire_index_writer.flush()
+            if millionaire_pool is not None:
+                millionaire_pool.shutdown()
     else:
         print('Please supply a "token.txt".')
 
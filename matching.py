@@ -0,0 +1,168 @@
+import functools
+import re
+import unicodedata
+from collections import Counter
+from itertools import chain
+
+
+NAME_STOPWORDS = frozenset([u'the', u'a', u'an', u'of', u'mr', u'mrs', u'ms', u'dr', u'sir', u'jr', u'sr'])
+# words that tell a sequel or a later part from the original, alongside numbers and roman numerals
+SEQUEL_WORDS = frozenset([u'part', u'chapter', u'episode', u'volume', u'vol', u'returns', u'rises', u'begins', u'reloaded',
+                          u'revolutions', u'resurrection', u'revenge', u'strikes', u'forever', u'again'])
+ROMAN_NUMERAL = re.compile(r'^(?=[ivxl])(xl|l?x{0,3})(ix|iv|v?i{0,3})$')
+# shortest first or last name that's accepted on its own, shorter ones ("doc", "old") only count alongside the rest of the name
+MIN_NAME_PART = 4
+
+
+def slugify(value):
+    value = str(unicodedata.normalize('NFKD', value).encode('ascii', 'ignore'), encoding='ascii')
+    value = re.sub(r'[^\w\s-]', '', value).strip().lower()
+    value = re.sub(r'[-\s]+', '-', value)
+    return value
+
+
+@functools.lru_cache(maxsize=4096)
+def normalize(text):
+    # slugify, split into words
+    return tuple(slugify(text).split(u'-'))
+
+
+def sequel_tokens(text):
+    # "Alien 3" -> {"3"}, "The Dark Knight Rises" -> {"rises"}
+    return frozenset(word for word in normalize(text) if word.isdigit() or word in SEQUEL_WORDS or ROMAN_NUMERAL.match(word))
+
+
+def within_distance(a, b, max_distance):
+    # Levenshtein distance of at most max_distance, giving up as soon as every row is past it
+    if abs(len(a) - len(b)) > max_distance:
+        return False
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > max_distance:
+            return False
+        previous = current
+    return previous[-1] <= max_distance
+
+
+def typo_allowance(word):
+    # short words are too close to too many others ("brown", "crown")
+    if len(word) < 6:
+        return 0
+    if len(word) < 9:
+        return 1
+    return 2
+
+
+@functools.lru_cache(maxsize=65536)
+def deletes(word, distance):
+    # every string reachable from word by removing up to distance characters. two words within
+    # edit distance d always share one of these, so it makes a cheap filter before the real check.
+    variants = set([word])
+    for _ in range(distance):
+        variants.update([variant[:i] + variant[i + 1:] for variant in variants for i in range(len(variant))])
+    return frozenset(variants)
+
+
+class AnswerMatcher:
+    # everything about the expected answer is worked out once, so each message only costs a normalize
+    # (usually cached) and a few set lookups
+    def __init__(self, answer, aliases=()):
+        self.names = []
+        # [(tokens, parts)]. a name matches when every one of its tokens is in the message, or any one of its
+        # first/last name parts is.
+        self.rules = []
+        # word -> typo allowance
+        self.words = {}
+        for name in (answer, *aliases):
+            words = normalize(name.strip())
+            if not any(words):
+                continue
+            self.names.append(u'-'.join(words))
+            tokens = [word for word in words if word not in NAME_STOPWORDS] or list(words)
+            parts = [word for word in tokens if len(word) >= MIN_NAME_PART] if len(tokens) > 1 else []
+            self.rules.append((frozenset(tokens), parts))
+            for word in tokens:
+                self.words[word] = typo_allowance(word)
+        self.max_allowance = max(self.words.values(), default=0)
+        self.variants = {}
+        for word, allowance in self.words.items():
+            for variant in deletes(word, allowance):
+                self.variants.setdefault(variant, []).append(word)
+        self.seen = {}
+
+    def match_word(self, word):
+        # the answer words this message word stands for, allowing for typos
+        if word in self.words:
+            return (word,)
+        if not typo_allowance(word) or not self.max_allowance:
+            return ()
+        matched = self.seen.get(word, None)
+        if matched is None:
+            candidates = set()
+            for variant in deletes(word, self.max_allowance) & self.variants.keys():
+                candidates.update(self.variants[variant])
+            matched = self.seen[word] = tuple(candidate for candidate in candidates
+                                              if within_distance(word, candidate, min([self.words[candidate], typo_allowance(word)])))
+        return matched
+
+    def match(self, text):
+        words = normalize(text.strip())
+        slug = u'-'.join(words)
+        for name in self.names:
+            if name in slug:
+                return True
+        matched = set(chain.from_iterable(self.match_word(word) for word in words))
+        for tokens, parts in self.rules:
+            if tokens <= matched or any(part in matched for part in parts):
+                return True
+        return False
+
+
+def trigrams(text):
+    padded = u'  ' + u' '.join(normalize(text)) + u' '
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class TrigramIndex:
+    # fuzzy lookup of short strings (titles) by shared trigrams, ranked by Jaccard similarity
+    def __init__(self):
+        self.items = {}
+        self.postings = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, key, text):
+        self.remove(key)
+        grams = trigrams(text)
+        self.items[key] = grams
+        for gram in grams:
+            self.postings.setdefault(gram, set()).add(key)
+
+    def remove(self, key):
+        grams = self.items.pop(key, None)
+        if grams:
+            for gram in grams:
+                self.postings[gram].discard(key)
+
+    def search(self, text, limit=5, threshold=0.3):
+        # [(score, key)], best first
+        grams = trigrams(text)
+        shared = Counter(chain.from_iterable(self.postings.get(gram, ()) for gram in grams))
+        # fewer shared trigrams than this can't reach threshold whatever the other title's length
+        min_count = threshold * len(grams) / (1 + threshold)
+        results = []
+        for key, count in shared.items():
+            if count >= min_count:
+                score = count / (len(grams) + len(self.items[key]) - count)
+                if score >= threshold:
+                    results.append((score, key))
+        results.sort(reverse=True)
+        return results[:limit]
+
+    def best(self, text, threshold=0.5):
+        results = self.search(text, 1, threshold)
+        return results[0][1] if results else None
@@ -0,0 +1,185 @@
+import asyncio
+import bisect
+import functools
+import inspect
+import json
+import time
+
+
+# upper bounds in seconds, anything slower lands in one last overflow bucket
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds, error=False):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if error:
+            self.errors += 1
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-th observation, so it overestimates by at most one bucket
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def serialize(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'total': self.total,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': [[bound, count] for bound, count in zip(self.buckets + (None,), self.counts) if count],
+        }
+
+
+class Timer:
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, exc_type is not None)
+        return False
+
+
+class NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Metrics:
+    # name -> latency histogram. everything checks enabled first, so while it's off a timed call
+    # costs one attribute lookup and no clock reads.
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.histograms = {}
+        # name -> stats() of some long-lived object, included in every dump
+        self.sources = {}
+        self.started = time.time()
+        self.task = None
+
+    def observe(self, name, seconds, error=False):
+        histogram = self.histograms.get(name, None)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(seconds, error)
+
+    def timer(self, name):
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, name)
+
+    def timed(self, name):
+        # decorator for plain functions, coroutines and generators. a generator is only charged for the
+        # time spent producing items, not for what its consumer does in between.
+        def decorator(func):
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def wrapper(*args, **kwargs):
+                    if not self.enabled:
+                        return await func(*args, **kwargs)
+                    with Timer(self, name):
+                        return await func(*args, **kwargs)
+            elif inspect.isgeneratorfunction(func):
+                @functools.wraps(func)
+                def wrapper(*args, **kwargs):
+                    if not self.enabled:
+                        return func(*args, **kwargs)
+                    return self.timed_iterator(name, func(*args, **kwargs))
+            else:
+                @functools.wraps(func)
+                def wrapper(*args, **kwargs):
+                    if not self.enabled:
+                        return func(*args, **kwargs)
+                    with Timer(self, name):
+                        return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def timed_iterator(self, name, iterator):
+        elapsed = 0.0
+        error = False
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                except BaseException:
+                    error = True
+                    raise
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield item
+        finally:
+            iterator.close()
+            self.observe(name, elapsed, error)
+
+    def add_source(self, name, stats):
+        self.sources[name] = stats
+
+    def snapshot(self):
+        return {
+            'time': time.time(),
+            'uptime': time.time() - self.started,
+            'latency': {name: histogram.serialize() for name, histogram in sorted(self.histograms.items())},
+            'stats': {name: stats() for name, stats in self.sources.items()},
+        }
+
+    def dump(self, path):
+        # one JSON object per line, totals are cumulative since startup
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(self.snapshot()) + '\n')
+
+    def start(self, loop, path, interval):
+        self.enabled = True
+        if self.task is None or self.task.done():
+            self.task = loop.create_task(self.run(path, interval))
+
+    async def run(self, path, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.dump(path)
+            except IOError as e:
+                print('Unable to write metrics: {}'.format(e))
+
+
+# shared by every module, enabled once lilbot starts dumping
+metrics = Metrics()
@@ -0,0 +1,411 @@
+import json
+import mmap
+import os
+import zlib
+
+import numpy as np
+
+from fileutil import atomic_write_json
+from millionaire_stats import *
+
+
+# a version 2+ round is fixed size, so a game's rounds can be copied out as one slice and viewed with this
+ROUND_DTYPE = np.dtype([
+    ('question', '<u4'),
+    ('amount', 'u1'),
+    ('lifelines_used', 'u1'),
+    ('answer', 'i1'),
+])
+
+# values of the answer column, anything >= 0 is the index of the wrong answer given
+ANSWER_CORRECT = -1
+ANSWER_TIME_UP = -2
+ANSWER_NONE = -3  # walked away
+
+DIFFICULTY_CODES = len([key for key in QUESTION_DIFFICULTY_MAP if isinstance(key, int)])
+CATEGORY_CODES = max(key for key in QUESTION_CATEGORY_MAP if isinstance(key, int)) + 1
+
+
+class History:
+    # every game and round in a stats directory, one array per column
+    def __init__(self, users, questions, games, rounds):
+        # user ids and Questions, indexed by the user and question columns
+        self.users = users
+        self.questions = questions
+        # user, timestamp, amount_earned, lifelines, first_round, round_count
+        self.games = games
+        # game, question, amount (DOLLAR_AMOUNT_MAP code), lifelines_used, answer
+        self.rounds = rounds
+        self.question_category = np.array([QUESTION_CATEGORY_MAP[question.category] for question in questions], dtype=np.uint8)
+        self.question_difficulty = np.array([QUESTION_DIFFICULTY_MAP[question.difficulty] for question in questions], dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.rounds['answer'])
+
+
+class HistoryBuilder:
+    def __init__(self, question_table):
+        self.users = []
+        self.user_ids = {}
+        # starts as the stats directory's question table, so version 2 ids can be used as is.
+        # questions only found inline in older files are numbered after it, without touching the table.
+        self.questions = list(question_table.questions)
+        self.question_ids = dict(question_table.ids)
+        self.game_columns = {name: [] for name in ('user', 'timestamp', 'amount_earned', 'lifelines', 'round_count')}
+        self.round_chunks = bytearray()
+
+    def user_id(self, user):
+        user_id = self.user_ids.get(user, None)
+        if user_id is None:
+            user_id = self.user_ids[user] = len(self.users)
+            self.users.append(user)
+        return user_id
+
+    def question_id(self, question):
+        key = QuestionTable.key(question)
+        question_id = self.question_ids.get(key, None)
+        if question_id is None:
+            question_id = self.question_ids[key] = len(self.questions)
+            self.questions.append(question)
+        return question_id
+
+    def add_game(self, user, lifelines, timestamp, amount_earned, rounds):
+        # rounds is packed ROUND_DTYPE bytes
+        columns = self.game_columns
+        columns['user'].append(self.user_id(user))
+        columns['lifelines'].append(lifelines)
+        columns['timestamp'].append(timestamp)
+        columns['amount_earned'].append(amount_earned)
+        columns['round_count'].append(len(rounds) // ROUND_DTYPE.itemsize)
+        self.round_chunks += rounds
+
+    def add_game_object(self, game):
+        rounds = np.zeros(len(game.rounds), dtype=ROUND_DTYPE)
+        for index, round in enumerate(game.rounds):
+            if round.given_answer == round.question.correct_answer:
+                answer = ANSWER_CORRECT
+            elif round.time_up:
+                answer = ANSWER_TIME_UP
+            elif round.given_answer is None:
+                answer = ANSWER_NONE
+            else:
+                answer = round.question.incorrect_answers.index(round.given_answer)
+            rounds[index] = (self.question_id(round.question), DOLLAR_AMOUNT_MAP[round.question_amount], round.lifelines_used or 0, answer)
+        self.add_game(game.user, game.lifelines, game.timestamp, game.amount_earned, rounds.tobytes())
+
+    def add_file(self, path, offset=0, skip=0):
+        # adds the games from offset on, ignoring the first skip of them. returns (offset past the last game, games added)
+        with open(path, 'rb') as read_byte_stream:
+            version = read_header(read_byte_stream)
+            offset = max([offset, read_byte_stream.tell()])
+        added = 0
+        if version < 2:
+            # inline questions, take the slow path
+            for game, offset in read_games(path, offset):
+                if skip:
+                    skip -= 1
+                    continue
+                self.add_game_object(game)
+                added += 1
+            return offset, added
+        file_size = os.path.getsize(path)
+        if file_size <= offset:
+            return offset, added
+        with open(path, 'rb') as read_byte_stream:
+            mapped = mmap.mmap(read_byte_stream.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(mapped)
+        try:
+            record_header = RECORD_HEADER.unpack_from
+            game_tail = GAME_TAIL.unpack_from
+            while offset + RECORD_HEADER.size <= file_size:
+                length, checksum = record_header(buf, offset)
+                pos = offset + RECORD_HEADER.size
+                end = pos + length
+                if end > file_size or zlib.crc32(buf[pos:end]) != checksum:
+                    break
+                if skip:
+                    skip -= 1
+                    offset = end
+                    continue
+                user_length = buf[pos]
+                user = str(buf[pos + 1:pos + 1 + user_length], 'utf-8')
+                pos += 1 + user_length
+                lifelines = buf[pos]
+                rounds_end = pos + 2 + buf[pos + 1] * ROUND_DTYPE.itemsize
+                game_timestamp, amount_earned = game_tail(buf, rounds_end)
+                self.add_game(user, lifelines, game_timestamp, amount_earned, buf[pos + 2:rounds_end])
+                added += 1
+                offset = end
+        finally:
+            buf.release()
+            mapped.close()
+        return offset, added
+
+    def build(self):
+        games = {
+            'user': np.array(self.game_columns['user'], dtype=np.int32),
+            'timestamp': np.array(self.game_columns['timestamp'], dtype=np.uint32),
+            'amount_earned': np.array(self.game_columns['amount_earned'], dtype=np.int32),
+            'lifelines': np.array(self.game_columns['lifelines'], dtype=np.uint8),
+            'round_count': np.array(self.game_columns['round_count'], dtype=np.uint8),
+        }
+        games['first_round'] = np.cumsum(games['round_count'], dtype=np.int64) - games['round_count']
+        packed = np.frombuffer(bytes(self.round_chunks), dtype=ROUND_DTYPE)
+        rounds = {name: np.ascontiguousarray(packed[name]) for name in ROUND_DTYPE.names}
+        rounds['question'] = rounds['question'].astype(np.int64)
+        rounds['game'] = np.repeat(np.arange(len(games['user']), dtype=np.int32), games['round_count'])
+        return History(self.users, self.questions, games, rounds)
+
+
+def load_history(stats_dir, ext='.mgd'):
+    builder = HistoryBuilder(get_question_table(stats_dir))
+    for filename in sorted(next(os.walk(stats_dir))[2]):
+        if filename.endswith(ext):
+            builder.add_file(os.path.join(stats_dir, filename))
+    return builder.build()
+
+
+COLUMNS_VERSION = 1
+COLUMNS = {
+    'games': [('user', '<i4'), ('timestamp', '<u4'), ('amount_earned', '<i4'), ('lifelines', 'u1'), ('round_count', 'u1'), ('first_round', '<i8')],
+    'rounds': [('game', '<i4'), ('question', '<i4'), ('amount', 'u1'), ('lifelines_used', 'u1'), ('answer', 'i1'), ('category', 'u1'), ('difficulty', 'u1')],
+    'questions': [('category', 'u1'), ('difficulty', 'u1'), ('type', 'u1')],
+}
+
+
+def code_dictionary(mapping):
+    return {str(code): value for code, value in mapping.items() if isinstance(code, int)}
+
+
+class ColumnStore:
+    # Files, all in one directory:
+    #   <table>.<column>.bin  raw little-endian values, one per row, np.memmap-able
+    #   questions.jsonl       question text, one line per questions row
+    #   manifest.json         row counts, dictionaries for the coded columns, and how far into each .mgd file the export got
+    # appends only become visible once the manifest is saved, anything past its row counts is an unfinished export.
+    def __init__(self, path):
+        self.path = path
+        self.manifest_path = os.path.join(path, 'manifest.json')
+        try:
+            manifest = json.load(open(self.manifest_path, 'r', encoding='utf-8'))
+        except IOError:
+            manifest = {'version': COLUMNS_VERSION, 'rows': {table: 0 for table in COLUMNS}, 'text_bytes': 0, 'users': [], 'files': {}}
+        if manifest['version'] != COLUMNS_VERSION:
+            raise ValueError('"{}" is not a version {} export.'.format(path, COLUMNS_VERSION))
+        self.rows = manifest['rows']
+        self.text_bytes = manifest['text_bytes']
+        self.users = manifest['users']
+        # filename -> {'version', 'offset', 'games'}
+        self.files = manifest['files']
+
+    def column_path(self, table, column):
+        return os.path.join(self.path, '{}.{}.bin'.format(table, column))
+
+    def column(self, table, column):
+        rows = self.rows[table]
+        dtype = np.dtype(dict(COLUMNS[table])[column])
+        if not rows:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self.column_path(table, column), dtype=dtype, mode='r', shape=(rows,))
+
+    def table(self, table):
+        return {column: self.column(table, column) for column, _ in COLUMNS[table]}
+
+    def read_questions(self):
+        questions = []
+        with open(os.path.join(self.path, 'questions.jsonl'), 'rb') as f:
+            for line in f.read(self.text_bytes).splitlines():
+                question = Question()
+                for name, value in json.loads(str(line, 'utf-8')).items():
+                    setattr(question, name, value)
+                questions.append(question)
+        return questions
+
+    def history(self):
+        return History(self.users, self.read_questions() if self.rows['questions'] else [], self.table('games'), self.table('rounds'))
+
+    def append(self, table, columns):
+        os.makedirs(self.path, exist_ok=True)
+        for column, dtype in COLUMNS[table]:
+            with open(self.column_path(table, column), 'ab') as f:
+                f.truncate(self.rows[table] * np.dtype(dtype).itemsize)
+                f.write(np.ascontiguousarray(columns[column], dtype=dtype).tobytes())
+
+    def append_questions(self, questions):
+        self.append('questions', {
+            'category': [QUESTION_CATEGORY_MAP[question.category] for question in questions],
+            'difficulty': [QUESTION_DIFFICULTY_MAP[question.difficulty] for question in questions],
+            'type': [QUESTION_TYPE_MAP[question.type] for question in questions],
+        })
+        with open(os.path.join(self.path, 'questions.jsonl'), 'ab') as f:
+            f.truncate(self.text_bytes)
+            f.write(b''.join(bytes(json.dumps(question.serialize()) + '\n', 'utf-8') for question in questions))
+            self.text_bytes = f.tell()
+        self.rows['questions'] += len(questions)
+
+    def save_manifest(self):
+        manifest = {
+            'version': COLUMNS_VERSION,
+            'rows': self.rows,
+            'text_bytes': self.text_bytes,
+            'users': self.users,
+            'files': self.files,
+            'columns': COLUMNS,
+            'dictionaries': {
+                'category': code_dictionary(QUESTION_CATEGORY_MAP),
+                'difficulty': code_dictionary(QUESTION_DIFFICULTY_MAP),
+                'type': code_dictionary(QUESTION_TYPE_MAP),
+                'amount': code_dictionary(DOLLAR_AMOUNT_MAP),
+            },
+        }
+        atomic_write_json(self.manifest_path, manifest)
+
+
+def export_history(stats_dir, export_dir, ext='.mgd'):
+    # converts only the games appended since the last export. returns (games, rounds) added.
+    store = ColumnStore(export_dir)
+    builder = HistoryBuilder(get_question_table(stats_dir))
+    progress = {}
+    for filename in sorted(next(os.walk(stats_dir))[2]):
+        if filename.endswith(ext):
+            path = os.path.join(stats_dir, filename)
+            exported = store.files.get(filename, {'version': None, 'offset': 0, 'games': 0})
+            with open(path, 'rb') as read_byte_stream:
+                version = read_header(read_byte_stream)
+            if version == exported['version'] and os.path.getsize(path) >= exported['offset']:
+                offset, added = builder.add_file(path, exported['offset'])
+            else:
+                # rewritten since, e.g. upgraded to a new version. same games at new offsets, so skip the ones already exported
+                offset, added = builder.add_file(path, skip=exported['games'])
+            progress[filename] = {'version': version, 'offset': offset, 'games': exported['games'] + added}
+    history = builder.build()
+    if not len(history.games['user']):
+        store.files.update(progress)
+        store.save_manifest()
+        return 0, 0
+
+    # map the builder's user and question ids onto the export's
+    user_ids = {user: user_id for user_id, user in enumerate(store.users)}
+    for user in history.users:
+        if user not in user_ids:
+            user_ids[user] = len(store.users)
+            store.users.append(user)
+    user_map = np.array([user_ids[user] for user in history.users], dtype=np.int32)
+    question_ids = {QuestionTable.key(question): question_id for question_id, question in enumerate(store.read_questions())} if store.rows['questions'] else {}
+    used = np.unique(history.rounds['question'])
+    question_map = np.full(len(history.questions), -1, dtype=np.int64)
+    new_questions = []
+    for question_id in used:
+        question = history.questions[question_id]
+        key = QuestionTable.key(question)
+        if key not in question_ids:
+            question_ids[key] = store.rows['questions'] + len(new_questions)
+            new_questions.append(question)
+        question_map[question_id] = question_ids[key]
+    if new_questions:
+        store.append_questions(new_questions)
+
+    games = history.games
+    rounds = history.rounds
+    store.append('games', dict(games, user=user_map[games['user']], first_round=games['first_round'] + store.rows['rounds']))
+    store.append('rounds', dict(rounds, game=rounds['game'] + store.rows['games'], question=question_map[rounds['question']],
+                                category=history.question_category[rounds['question']], difficulty=history.question_difficulty[rounds['question']]))
+    store.rows['games'] += len(games['user'])
+    store.rows['rounds'] += len(rounds['game'])
+    store.files.update(progress)
+    store.save_manifest()
+    return len(games['user']), len(rounds['game'])
+
+
+def correct_rates(keys, attempted, correct, size, prior, prior_weight):
+    # (smoothed correct rate, attempts) per key. keys with few attempts stay close to their prior.
+    attempts = np.bincount(keys[attempted], minlength=size)
+    hits = np.bincount(keys[attempted & correct], minlength=size)
+    return (hits + prior_weight * prior) / (attempts + prior_weight), attempts
+
+
+def calibrate(history, prior_weight=5.0):
+    # measured chance of a correct answer per question, falling back to (category, difficulty) and then
+    # difficulty label for questions seen too rarely. lifeline rounds are left out since they're easier.
+    rounds = history.rounds
+    answer = rounds['answer']
+    correct = answer == ANSWER_CORRECT
+    attempted = answer != ANSWER_NONE
+    unassisted = attempted & (rounds['lifelines_used'] == 0)
+    question = rounds['question']
+    difficulty = history.question_difficulty[question]
+    cell = history.question_category[question].astype(np.int64) * DIFFICULTY_CODES + difficulty
+
+    overall = correct[unassisted].mean() if unassisted.any() else 0.5
+    difficulty_rates, difficulty_attempts = correct_rates(difficulty, unassisted, correct, DIFFICULTY_CODES, overall, prior_weight)
+    cell_rates, cell_attempts = correct_rates(cell, unassisted, correct, CATEGORY_CODES * DIFFICULTY_CODES,
+                                              np.tile(difficulty_rates, CATEGORY_CODES), prior_weight)
+    question_cells = history.question_category.astype(np.int64) * DIFFICULTY_CODES + history.question_difficulty
+    question_rates, question_attempts = correct_rates(question, unassisted, correct, len(history.questions),
+                                                      cell_rates[question_cells], prior_weight)
+
+    # lifelines: how much better than a question's expected rate the rounds using them did
+    lifelines = rounds['lifelines_used']
+    lift = np.bincount(lifelines[attempted], weights=(correct - question_rates[question])[attempted], minlength=4)
+    lifeline_attempts = np.bincount(lifelines[attempted], minlength=4)
+    lifeline_hits = np.bincount(lifelines[attempted & correct], minlength=4)
+
+    amount = rounds['amount']
+    level_attempts = np.bincount(amount[attempted], minlength=len(DOLLAR_AMOUNT_MAP) // 2)
+    level_hits = np.bincount(amount[attempted & correct], minlength=len(DOLLAR_AMOUNT_MAP) // 2)
+
+    return {
+        'rounds': len(history),
+        'games': len(history.games['user']),
+        'difficulties': {
+            QUESTION_DIFFICULTY_MAP[code]: [difficulty_rates[code], int(difficulty_attempts[code])]
+            for code in range(DIFFICULTY_CODES)
+        },
+        'cells': {
+            u'{}|{}'.format(QUESTION_CATEGORY_MAP[code // DIFFICULTY_CODES], QUESTION_DIFFICULTY_MAP[code % DIFFICULTY_CODES]): [cell_rates[code], int(cell_attempts[code])]
+            for code in np.flatnonzero(cell_attempts)
+        },
+        'questions': {
+            history.questions[question_id].question: [question_rates[question_id], int(question_attempts[question_id])]
+            for question_id in np.flatnonzero(question_attempts)
+        },
+        'levels': {
+            str(DOLLAR_AMOUNT_MAP[code]): [level_hits[code] / level_attempts[code], int(level_attempts[code])]
+            for code in np.flatnonzero(level_attempts)
+        },
+        'lifelines': {
+            str(used): {
+                'correct_rate': lifeline_hits[used] / lifeline_attempts[used],
+                'lift': lift[used] / lifeline_attempts[used],
+                'attempts': int(lifeline_attempts[used]),
+            } for used in np.flatnonzero(lifeline_attempts)
+        },
+    }
+
+
+def save_difficulty_table(table, path):
+    atomic_write_json(path, table, default=float)
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    if len(sys.argv) >= 2 and sys.argv[1] == 'calibrate':
+        stats_dir = sys.argv[2] if len(sys.argv) > 2 else 'millionaire_stats'
+        path = sys.argv[3] if len(sys.argv) > 3 else 'millionaire_difficulty.json'
+        start = time.time()
+        history = load_history(stats_dir)
+        loaded = time.time()
+        table = calibrate(history)
+        save_difficulty_table(table, path)
+        print('Calibrated {:,} questions from {:,} rounds ({:.2f}s loading, {:.2f}s calibrating).'.format(
+            len(table['questions']), len(history), loaded - start, time.time() - loaded))
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'export':
+        stats_dir = sys.argv[2] if len(sys.argv) > 2 else 'millionaire_stats'
+        export_dir = sys.argv[3] if len(sys.argv) > 3 else 'millionaire_columns'
+        start = time.time()
+        games, rounds = export_history(stats_dir, export_dir)
+        print('Exported {:,} new games and {:,} new rounds in {:.2f}s.'.format(games, rounds, time.time() - start))
+    else:
+        print('usage: python millionaire_analytics.py calibrate [stats_dir] [table_path]')
+        print('       python millionaire_analytics.py export [stats_dir] [export_dir]')
@@ -1,5 +1,13 @@
+import io
+import json
+import mmap
+import os
+import struct
 import time
 import html
+import zlib
+
+from metrics import metrics
 
 
 # NOTE: we'll probably want to replace this with something that keeps the original mapping intact
@@ -68,6 +76,51 @@ def write_string(byte_stream, s):
     byte_stream.write(str_bytes)
 
 
+MGD_MAGIC = b'MGD'
+MGD_VERSION = 2
+MQD_MAGIC = b'MQD'
+MQD_VERSION = 1
+QUESTION_TABLE_FILENAME = 'questions.mqd'
+
+# length, crc32 of the payload that follows
+RECORD_HEADER = struct.Struct('<II')
+
+
+def read_header(byte_stream, magic=MGD_MAGIC):
+    header = byte_stream.read(len(magic) + 1)
+    if len(header) == len(magic) + 1 and header.startswith(magic):
+        return header[-1]
+    # version 0 files have no header and start with the first game
+    byte_stream.seek(0)
+    return 0
+
+
+def write_header(byte_stream, version=MGD_VERSION, magic=MGD_MAGIC):
+    byte_stream.write(magic)
+    write_u8(byte_stream, version)
+
+
+def write_record(byte_stream, obj, *args):
+    payload = io.BytesIO()
+    obj.write(payload, *args)
+    payload = payload.getvalue()
+    # one write call so a crash leaves at most one torn record at the end
+    byte_stream.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+
+
+def read_records(byte_stream):
+    # stops at the first short or corrupt record, which can only be a torn write at the end of the file
+    while True:
+        header = byte_stream.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        length, checksum = RECORD_HEADER.unpack(header)
+        payload = byte_stream.read(length)
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            return
+        yield payload, byte_stream.tell()
+
+
 QUESTION_CATEGORY_MAP = two_way_map({
     9: u"General Knowledge",
     10: u"Entertainment: Books",
@@ -208,8 +261,11 @@ class MillionaireRound:
         return cls(question, question_amount, lifelines_used, round_result)
     
     @classmethod
-    def read(cls, byte_stream):
-        question = Question.read(byte_stream)
+    def read(cls, byte_stream, question_table=None):
+        if question_table is None:
+            question = Question.read(byte_stream)
+        else:
+            question = question_table[read_u32(byte_stream)]
         question_amount = DOLLAR_AMOUNT_MAP[read_u8(byte_stream)]
         lifelines_used = read_u8(byte_stream)
         given_answer_index = read_i8(byte_stream)
@@ -224,8 +280,11 @@ class MillionaireRound:
                 time_up = True
         return cls(question, question_amount, lifelines_used, given_answer, time_up)
     
-    def write(self, byte_stream):
-        self.question.write(byte_stream)
+    def write(self, byte_stream, question_table=None):
+        if question_table is None:
+            self.question.write(byte_stream)
+        else:
+            write_u32(byte_stream, question_table.add(self.question))
         write_u8(byte_stream, DOLLAR_AMOUNT_MAP[self.question_amount])
         write_u8(byte_stream, self.lifelines_used)
         if self.given_answer == self.question.correct_answer:
@@ -265,21 +324,418 @@ class MillionaireGame:
         return cls(user, lifelines, rounds, timestamp, amount_earned)
     
     @classmethod
-    def read(cls, byte_stream):
+    def read(cls, byte_stream, question_table=None):
         user = read_string(byte_stream)
         lifelines = read_u8(byte_stream)
-        rounds = read_list(byte_stream, MillionaireRound.read)
+        rounds = read_list(byte_stream, lambda byte_stream: MillionaireRound.read(byte_stream, question_table))
         timestamp = read_u32(byte_stream)
         amount_earned = read_i32(byte_stream)
         return cls(user, lifelines, rounds, timestamp, amount_earned)
     
-    def write(self, byte_stream):
+    def write(self, byte_stream, question_table=None):
         write_string(byte_stream, self.user)
         write_u8(byte_stream, self.lifelines)
-        write_list(byte_stream, self.rounds)
+        write_u8(byte_stream, len(self.rounds))
+        for round in self.rounds:
+            round.write(byte_stream, question_table)
         write_u32(byte_stream, self.timestamp)
         write_i32(byte_stream, self.amount_earned)
 
 
+class QuestionTable:
+    # append-only dictionary of every question referenced by version 2+ game files; ids are record indexes
+    def __init__(self, path):
+        self.path = path
+        self.questions = []
+        self.ids = {}
+        self.offset = 0
+        self.refresh()
+
+    @staticmethod
+    def key(question):
+        # the whole encoded question, rounds store their given answer as an index into its own answer list
+        payload = io.BytesIO()
+        question.write(payload)
+        return payload.getvalue()
+
+    @metrics.timed('millionaire_stats.QuestionTable.refresh')
+    def refresh(self):
+        # picks up questions appended since the last refresh, possibly by another process
+        try:
+            read_byte_stream = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+        with read_byte_stream:
+            if not self.offset:
+                if not os.fstat(read_byte_stream.fileno()).st_size:
+                    return
+                if read_header(read_byte_stream, MQD_MAGIC) != MQD_VERSION:
+                    raise ValueError('"{}" is not a version {} question table.'.format(self.path, MQD_VERSION))
+                self.offset = read_byte_stream.tell()
+            read_byte_stream.seek(self.offset)
+            for payload, self.offset in read_records(read_byte_stream):
+                question = Question.read(io.BytesIO(payload))
+                self.ids.setdefault(payload, len(self.questions))
+                self.questions.append(question)
+
+    def __getitem__(self, question_id):
+        if question_id >= len(self.questions):
+            self.refresh()
+        return self.questions[question_id]
+
+    def __len__(self):
+        return len(self.questions)
+
+    def add(self, question):
+        key = self.key(question)
+        question_id = self.ids.get(key, None)
+        if question_id is None:
+            self.refresh()
+            question_id = self.ids.get(key, None)
+        if question_id is None:
+            with open(self.path, 'ab') as write_byte_stream:
+                if not write_byte_stream.tell():
+                    write_header(write_byte_stream, MQD_VERSION, MQD_MAGIC)
+                elif write_byte_stream.tell() > self.offset:
+                    truncate_games(self.path, self.offset)
+                write_record(write_byte_stream, question)
+                self.offset = write_byte_stream.tell()
+            question_id = len(self.questions)
+            self.ids[key] = question_id
+            self.questions.append(question)
+        return question_id
+
+    @metrics.timed('millionaire_stats.QuestionTable.sync')
+    def sync(self):
+        with open(self.path, 'ab') as write_byte_stream:
+            os.fsync(write_byte_stream.fileno())
+
+
+QUESTION_TABLES = {}
+
+
+def get_question_table(stats_dir):
+    # one shared table per stats directory, so game files only need to know where they live
+    path = os.path.join(stats_dir, QUESTION_TABLE_FILENAME)
+    question_table = QUESTION_TABLES.get(path, None)
+    if question_table is None:
+        question_table = QUESTION_TABLES[path] = QuestionTable(path)
+    return question_table
+
+
+def get_game_question_table(path, version):
+    if version >= 2:
+        return get_question_table(os.path.dirname(path))
+    return None
+
+
+class MillionaireSummary:
+    def __init__(self, user=None, total_earned=0, highest_earned=0, games_played=0, last_timestamp=0, offset=0, version=0):
+        self.user = user
+        self.total_earned = total_earned
+        self.highest_earned = highest_earned
+        self.games_played = games_played
+        self.last_timestamp = last_timestamp
+        # number of bytes of the user's file covered by this summary
+        self.offset = offset
+        # offsets are only meaningful for the file version they were taken from
+        self.version = version
+
+    def add(self, game, offset):
+        self.user = game.user
+        self.total_earned += game.amount_earned
+        self.highest_earned = max([self.highest_earned, game.amount_earned])
+        self.games_played += 1
+        self.last_timestamp = max([self.last_timestamp, game.timestamp])
+        self.offset = offset
+
+    def serialize(self):
+        return {
+            'user': self.user,
+            'total_earned': self.total_earned,
+            'highest_earned': self.highest_earned,
+            'games_played': self.games_played,
+            'last_timestamp': self.last_timestamp,
+            'offset': self.offset,
+            'version': self.version,
+        }
+
+    @classmethod
+    def deserialize(cls, ser_dict):
+        return cls(**ser_dict)
+
+
+class DifficultyTable:
+    # measured chance of answering a question correctly, written by `python millionaire_analytics.py calibrate`.
+    # falls back to (category, difficulty), then the difficulty label, for questions it hasn't seen
+    DEFAULT_RATES = {u'easy': 0.8, u'medium': 0.6, u'hard': 0.4}
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        # text -> [rate, attempts]
+        self.questions = {}
+        # "category|difficulty" -> [rate, attempts]
+        self.cells = {}
+        # difficulty -> [rate, attempts]
+        self.difficulties = {}
+        self.refresh()
+
+    def __bool__(self):
+        return bool(self.questions or self.cells)
+
+    def refresh(self):
+        # picks up a new calibration without a restart
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self.mtime:
+            return
+        try:
+            table = json.load(open(self.path, 'r', encoding='utf-8'))
+        except (IOError, ValueError):
+            return
+        self.mtime = mtime
+        self.questions = table.get('questions', {})
+        self.cells = table.get('cells', {})
+        self.difficulties = table.get('difficulties', {})
+
+    def estimate(self, question):
+        for rates, key in ((self.questions, question.question),
+                           (self.cells, u'{}|{}'.format(question.category, question.difficulty)),
+                           (self.difficulties, question.difficulty)):
+            entry = rates.get(key, None)
+            if entry and entry[1]:
+                return entry[0]
+        return self.DEFAULT_RATES.get(question.difficulty, 0.5)
+
+    def order(self, questions):
+        # easiest first, the dollar ladder climbs in measured difficulty
+        return sorted(questions, key=self.estimate, reverse=True)
+
+
+@metrics.timed('millionaire_stats.read_games')
+def read_games(path, offset=0, recover=False):
+    # yields (game, offset just past the game) so callers can resume later
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as read_byte_stream:
+        version = read_header(read_byte_stream)
+        offset = max([offset, read_byte_stream.tell()])
+        read_byte_stream.seek(offset)
+        if version == 0:
+            while read_byte_stream.tell() < file_size:
+                game = MillionaireGame.read(read_byte_stream)
+                yield game, read_byte_stream.tell()
+            return
+        question_table = get_game_question_table(path, version)
+        for payload, offset in read_records(read_byte_stream):
+            yield MillionaireGame.read(io.BytesIO(payload), question_table), offset
+    if recover and offset < file_size:
+        truncate_games(path, offset)
+
+
+# precompiled layouts for the bulk decoder
+QUESTION_ID = struct.Struct('<I')
+QUESTION_HEAD = struct.Struct('<BBB')  # category, type, difficulty
+ROUND_TAIL = struct.Struct('<BBb')  # question_amount, lifelines_used, given_answer
+GAME_TAIL = struct.Struct('<Ii')  # timestamp, amount_earned
+
+
+def unpack_game(buf, pos, question_table=None):
+    # same layout as MillionaireGame.read, walked over a memoryview instead of a stream
+    question_id = QUESTION_ID.unpack_from
+    question_head = QUESTION_HEAD.unpack_from
+    round_tail = ROUND_TAIL.unpack_from
+
+    length = buf[pos]
+    pos += 1
+    user = str(buf[pos:pos + length], 'utf-8')
+    pos += length
+    lifelines = buf[pos]
+    rounds = [None] * buf[pos + 1]
+    pos += 2
+    for round_index in range(len(rounds)):
+        if question_table is not None:
+            question = question_table[question_id(buf, pos)[0]]
+            pos += QUESTION_ID.size
+            amount, lifelines_used, given_answer_index = round_tail(buf, pos)
+            pos += 3
+            if given_answer_index == -1:
+                rounds[round_index] = MillionaireRound(question, DOLLAR_AMOUNT_MAP[amount], lifelines_used, question.correct_answer)
+            elif given_answer_index >= 0:
+                rounds[round_index] = MillionaireRound(question, DOLLAR_AMOUNT_MAP[amount], lifelines_used, question.incorrect_answers[given_answer_index])
+            else:
+                rounds[round_index] = MillionaireRound(question, DOLLAR_AMOUNT_MAP[amount], lifelines_used, None, given_answer_index == -2)
+            continue
+        question = Question()
+        category, question_type, difficulty = question_head(buf, pos)
+        question.category = QUESTION_CATEGORY_MAP[category]
+        question.type = QUESTION_TYPE_MAP[question_type]
+        question.difficulty = QUESTION_DIFFICULTY_MAP[difficulty]
+        pos += 3
+        length = buf[pos]
+        pos += 1
+        question.question = str(buf[pos:pos + length], 'utf-8')
+        pos += length
+        length = buf[pos]
+        pos += 1
+        question.correct_answer = str(buf[pos:pos + length], 'utf-8')
+        pos += length
+        incorrect_answers = [None] * buf[pos]
+        pos += 1
+        for answer_index in range(len(incorrect_answers)):
+            length = buf[pos]
+            pos += 1
+            incorrect_answers[answer_index] = str(buf[pos:pos + length], 'utf-8')
+            pos += length
+        question.incorrect_answers = incorrect_answers
+
+        amount, lifelines_used, given_answer_index = round_tail(buf, pos)
+        pos += 3
+        time_up = False
+        if given_answer_index == -1:
+            given_answer = question.correct_answer
+        elif given_answer_index >= 0:
+            given_answer = incorrect_answers[given_answer_index]
+        else:
+            given_answer = None
+            time_up = given_answer_index == -2
+        rounds[round_index] = MillionaireRound(question, DOLLAR_AMOUNT_MAP[amount], lifelines_used, given_answer, time_up)
+    game_timestamp, amount_earned = GAME_TAIL.unpack_from(buf, pos)
+    pos += GAME_TAIL.size
+    return MillionaireGame(user, lifelines, rounds, game_timestamp, amount_earned), pos
+
+
+@metrics.timed('millionaire_stats.mmap_read_games')
+def mmap_read_games(path, offset=0, recover=False):
+    # drop-in replacement for read_games that maps the file instead of streaming it
+    file_size = os.path.getsize(path)
+    if not file_size:
+        return
+    with open(path, 'rb') as read_byte_stream:
+        version = read_header(read_byte_stream)
+        offset = max([offset, read_byte_stream.tell()])
+        mapped = mmap.mmap(read_byte_stream.fileno(), 0, access=mmap.ACCESS_READ)
+    buf = memoryview(mapped)
+    try:
+        if version == 0:
+            while offset < file_size:
+                game, offset = unpack_game(buf, offset)
+                yield game, offset
+            return
+        question_table = get_game_question_table(path, version)
+        record_header = RECORD_HEADER.unpack_from
+        while offset + RECORD_HEADER.size <= file_size:
+            length, checksum = record_header(buf, offset)
+            start = offset + RECORD_HEADER.size
+            end = start + length
+            if end > file_size or zlib.crc32(buf[start:end]) != checksum:
+                break
+            game, _ = unpack_game(buf, start, question_table)
+            offset = end
+            yield game, offset
+    finally:
+        buf.release()
+        mapped.close()
+    if recover and offset < file_size:
+        truncate_games(path, offset)
+
+
+GAME_READERS = {
+    'stream': read_games,
+    'mmap': mmap_read_games,
+}
+
+
+@metrics.timed('millionaire_stats.truncate_games')
+def truncate_games(path, offset):
+    print('Cutting off {} torn bytes from "{}".'.format(os.path.getsize(path) - offset, path))
+    os.truncate(path, offset)
+
+
+@metrics.timed('millionaire_stats.upgrade_games')
+def upgrade_games(path):
+    # makes sure the file exists and is in the current version, rewriting it once if it isn't
+    try:
+        with open(path, 'rb') as read_byte_stream:
+            version = read_header(read_byte_stream)
+    except FileNotFoundError:
+        version = None
+    if version == MGD_VERSION:
+        return False
+    question_table = get_game_question_table(path, MGD_VERSION)
+    temp_path = path + '.temp'
+    with open(temp_path, 'wb') as write_byte_stream:
+        write_header(write_byte_stream)
+        if version is not None:
+            for game, _ in read_games(path):
+                write_record(write_byte_stream, game, question_table)
+    os.replace(temp_path, path)
+    return True
+
+
+@metrics.timed('millionaire_stats.append_game')
+def append_game(path, game, fsync=False):
+    question_table = get_game_question_table(path, MGD_VERSION)
+    with open(path, 'ab') as write_byte_stream:
+        write_record(write_byte_stream, game, question_table)
+        write_byte_stream.flush()
+        if fsync:
+            # the game's question ids have to survive at least as long as the game does
+            question_table.sync()
+            os.fsync(write_byte_stream.fileno())
+        return write_byte_stream.tell()
+
+
+@metrics.timed('millionaire_stats.summarize_games')
+def summarize_games(path, summary=None, reader='stream'):
+    with open(path, 'rb') as read_byte_stream:
+        version = read_header(read_byte_stream)
+        data_offset = read_byte_stream.tell()
+    if summary is None or summary.version != version or os.path.getsize(path) < summary.offset:
+        # file was rewritten out from under the summary, start over
+        summary = MillionaireSummary(offset=data_offset, version=version)
+    for game, offset in GAME_READERS[reader](path, summary.offset):
+        summary.add(game, offset)
+    return summary
+
+
+def summarize_game_files(jobs, reader='stream'):
+    # process pool worker. [(path, MillionaireSummary or None)] -> [MillionaireSummary, or None if the file is gone]
+    summaries = []
+    for path, summary in jobs:
+        try:
+            summaries.append(summarize_games(path, summary, reader))
+        except FileNotFoundError:
+            summaries.append(None)
+    return summaries
+
+
+def migrate_games(stats_dir, ext='.mgd'):
+    # one-shot upgrade of every game file in stats_dir to the current version
+    before = after = 0
+    for filename in sorted(next(os.walk(stats_dir))[2]):
+        if filename.endswith(ext):
+            path = os.path.join(stats_dir, filename)
+            size = os.path.getsize(path)
+            if upgrade_games(path):
+                before += size
+                after += os.path.getsize(path)
+                print('Migrated "{}" ({:,} -> {:,} bytes).'.format(path, size, os.path.getsize(path)))
+    question_table_path = os.path.join(stats_dir, QUESTION_TABLE_FILENAME)
+    if os.path.exists(question_table_path):
+        after += os.path.getsize(question_table_path)
+    print('{:,} bytes before, {:,} bytes after (including the question table).'.format(before, after))
+
+
 def timestamp():
     return int(time.time())
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) >= 2 and sys.argv[1] == 'migrate':
+        migrate_games(sys.argv[2] if len(sys.argv) > 2 else 'millionaire_stats')
+    else:
+        print('usage: python millionaire_stats.py migrate [stats_dir]')
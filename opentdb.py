@@ -0,0 +1,179 @@
+import asyncio
+import functools
+import json
+import re
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from fileutil import atomic_write_json
+from metrics import metrics
+
+
+OPENTDB_URL = 'https://opentdb.com/'
+
+CATEGORY_ALIASES = {
+    u'general': 9,
+    u'gk': 9,
+    u'literature': 10,
+    u'movies': 11,
+    u'movie': 11,
+    u'films': 11,
+    u'theatre': 13,
+    u'theater': 13,
+    u'tv': 14,
+    u'games': 15,
+    u'video game': 15,
+    u'videogames': 15,
+    u'board game': 16,
+    u'science': 17,
+    u'nature': 17,
+    u'computer': 18,
+    u'cs': 18,
+    u'math': 19,
+    u'maths': 19,
+    u'sport': 21,
+    u'celebrity': 26,
+    u'animal': 27,
+    u'cars': 28,
+    u'comic': 29,
+    u'gadget': 30,
+    u'anime': 31,
+    u'manga': 31,
+    u'cartoons': 32,
+    u'cartoon': 32,
+    u'animation': 32,
+}
+
+
+def normalize_category(text):
+    text = unicodedata.normalize('NFKD', text).lower().replace(u'&', u' and ')
+    text = re.sub(r'[^\w\s]', ' ', text)
+    return u' '.join(text.split())
+
+
+def build_category_index(categories, aliases=CATEGORY_ALIASES):
+    # normalized name/alias -> category id
+    index = {}
+    for category_id, name in categories:
+        index[str(category_id)] = category_id
+        index[normalize_category(name)] = category_id
+        if u':' in name:
+            # "Entertainment: Film" -> "film"
+            index.setdefault(normalize_category(name.split(u':', 1)[1]), category_id)
+    for alias, category_id in aliases.items():
+        index.setdefault(normalize_category(alias), category_id)
+    return index
+
+
+def resolve_category(index, text):
+    key = normalize_category(text)
+    category_id = index.get(key, None)
+    if category_id is None and key:
+        matches = set(value for name, value in index.items() if name.startswith(key))
+        if len(matches) == 1:
+            category_id = matches.pop()
+    return category_id
+
+
+class ResponseCache:
+    # url -> last response body, persisted across restarts
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        try:
+            self.entries = json.load(open(path, 'r', encoding='utf-8'))
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def get(self, key):
+        return self.entries.get(key, None)
+
+    def is_fresh(self, entry):
+        return time.time() - entry['fetched'] < self.ttl
+
+    def put(self, key, body, etag=None, last_modified=None):
+        self.entries[key] = {
+            'body': body,
+            'fetched': time.time(),
+            'etag': etag,
+            'last_modified': last_modified,
+        }
+        self.save()
+
+    def touch(self, key):
+        self.entries[key]['fetched'] = time.time()
+        self.save()
+
+    def save(self):
+        atomic_write_json(self.path, self.entries)
+
+
+class OpenTDBClient:
+    # requests is blocking, so calls run on a small thread pool sharing one keep-alive session
+    def __init__(self, base_url=OPENTDB_URL, timeout=10, max_concurrency=4, cache=None):
+        self.base_url = base_url
+        self.cache = cache
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def request(self, endpoint, timeout=None, headers=None, **params):
+        url = self.base_url + endpoint
+        request = functools.partial(self.session.get, url, params=params, headers=headers, timeout=timeout or self.timeout)
+        async with self.semaphore:
+            with metrics.timer('opentdb.' + endpoint):
+                response = await asyncio.get_event_loop().run_in_executor(self.executor, request)
+                response.raise_for_status()
+        return response
+
+    async def get(self, endpoint, timeout=None, **params):
+        response = await self.request(endpoint, timeout, **params)
+        return response.json()
+
+    async def get_cached(self, endpoint, timeout=None, **params):
+        if self.cache is None:
+            return await self.get(endpoint, timeout, **params)
+        key = endpoint + u'?' + u'&'.join(u'{}={}'.format(name, value) for name, value in sorted(params.items()))
+        entry = self.cache.get(key)
+        if entry and self.cache.is_fresh(entry):
+            return entry['body']
+        headers = {}
+        if entry:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        try:
+            response = await self.request(endpoint, timeout, headers, **params)
+        except requests.RequestException:
+            if entry:
+                # stale is better than nothing
+                return entry['body']
+            raise
+        if response.status_code == 304 and entry:
+            self.cache.touch(key)
+            return entry['body']
+        body = response.json()
+        self.cache.put(key, body, response.headers.get('ETag', None), response.headers.get('Last-Modified', None))
+        return body
+
+    async def get_session_token(self):
+        return await self.get('api_token.php', command='request')
+
+    async def get_questions(self, amount, category=None, difficulty=None, session_token=None):
+        return await self.get('api.php', amount=amount, type='multiple', category=category, difficulty=difficulty, token=session_token)
+
+    async def get_categories(self):
+        return await self.get_cached('api_category.php')
+
+    def close(self):
+        self.session.close()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,154 @@
+import asyncio
+import time
+from collections import deque
+
+
+MAX_MESSAGE_LENGTH = 2000
+
+
+class RateLimitBucket:
+    # at most limit sends in any period seconds. a sliding window, so it also stays inside whatever fixed
+    # windows the server counts in.
+    def __init__(self, limit, period):
+        self.limit = limit
+        self.period = period
+        self.sent = deque(maxlen=limit)
+        self.blocked_until = 0.0
+
+    def delay(self):
+        # seconds until the next send is allowed
+        now = time.monotonic()
+        delay = self.blocked_until - now
+        if len(self.sent) == self.limit:
+            delay = max([delay, self.sent[0] + self.period - now])
+        return max([delay, 0.0])
+
+    def take(self):
+        self.sent.append(time.monotonic())
+
+    def finish(self):
+        # the server counted the send somewhere between take() and now, assume the latest
+        if self.sent:
+            self.sent[-1] = time.monotonic()
+
+    def block(self, seconds):
+        # the server says we're limited whatever we think, so wait it out
+        self.blocked_until = time.monotonic() + seconds
+
+
+class ChannelQueue:
+    def __init__(self, max_pending, limit, period):
+        # (content, kwargs, future or None)
+        self.pending = deque()
+        self.space = asyncio.Semaphore(max_pending)
+        self.bucket = RateLimitBucket(limit, period)
+        self.task = None
+
+
+class Outbox:
+    # one queue and one worker per channel, so a channel's messages go out in the order they were posted.
+    # text messages waiting behind a rate limit are merged into as few sends as fit under max_length.
+    def __init__(self, send, limit=5, period=5.0, global_limit=50, global_period=1.0, max_pending=20,
+                 max_length=MAX_MESSAGE_LENGTH, retry_after=None):
+        # send(channel, content, **kwargs) is the real send, retry_after(exception) -> seconds or None for
+        # errors that mean the server rate limited us and the send should be retried
+        self.send_now = send
+        self.limit = limit
+        self.period = period
+        self.max_pending = max_pending
+        self.max_length = max_length
+        self.retry_after = retry_after
+        self.global_bucket = RateLimitBucket(global_limit, global_period)
+        # channel id -> ChannelQueue
+        self.channels = {}
+        self.sends = 0
+        self.coalesced = 0
+
+    def get_queue(self, channel):
+        channel_id = getattr(channel, 'id', channel)
+        queue = self.channels.get(channel_id, None)
+        if queue is None:
+            queue = self.channels[channel_id] = ChannelQueue(self.max_pending, self.limit, self.period)
+        return queue
+
+    async def post(self, channel, content=None, wait=False, **kwargs):
+        # returns once there's room in the channel's queue (or once it's sent, if wait)
+        queue = self.get_queue(channel)
+        await queue.space.acquire()
+        future = asyncio.get_event_loop().create_future() if wait else None
+        queue.pending.append((content, kwargs, future))
+        if queue.task is None or queue.task.done():
+            queue.task = asyncio.get_event_loop().create_task(self.run(channel, queue))
+        if future is not None:
+            return await future
+
+    async def send(self, channel, content=None, **kwargs):
+        # the sent message, which may also carry other posts merged into it
+        return await self.post(channel, content, wait=True, **kwargs)
+
+    def take_batch(self, queue):
+        content, kwargs, future = queue.pending.popleft()
+        futures = [future]
+        if content is not None and not kwargs:
+            parts = [content]
+            length = len(content)
+            while queue.pending:
+                next_content, next_kwargs, next_future = queue.pending[0]
+                if next_content is None or next_kwargs or length + 1 + len(next_content) > self.max_length:
+                    break
+                queue.pending.popleft()
+                parts.append(next_content)
+                length += 1 + len(next_content)
+                futures.append(next_future)
+            content = u'\n'.join(parts)
+            self.coalesced += len(parts) - 1
+        return content, kwargs, futures
+
+    async def run(self, channel, queue):
+        while queue.pending:
+            content, kwargs, futures = self.take_batch(queue)
+            try:
+                message = await self.deliver(channel, queue, content, kwargs)
+            except Exception as e:
+                waiting = [future for future in futures if future is not None]
+                if not waiting:
+                    print('Unable to send message to {}: {}'.format(getattr(channel, 'id', channel), e))
+                for future in waiting:
+                    # a caller that was cancelled already has its answer
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for future in futures:
+                    if future is not None and not future.done():
+                        future.set_result(message)
+            finally:
+                for _ in futures:
+                    queue.space.release()
+
+    async def deliver(self, channel, queue, content, kwargs):
+        while True:
+            delay = max([queue.bucket.delay(), self.global_bucket.delay()])
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+            queue.bucket.take()
+            self.global_bucket.take()
+            try:
+                message = await self.send_now(channel, content, **kwargs)
+            except Exception as e:
+                retry_after = self.retry_after(e) if self.retry_after else None
+                if retry_after is None:
+                    raise
+                queue.bucket.block(retry_after)
+                continue
+            finally:
+                queue.bucket.finish()
+            self.sends += 1
+            return message
+
+    def stats(self):
+        return {
+            'sends': self.sends,
+            'coalesced': self.coalesced,
+            'pending': sum(len(queue.pending) for queue in self.channels.values()),
+        }
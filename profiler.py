@@ -0,0 +1,134 @@
+import asyncio
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import random
+import re
+import time
+import types
+
+
+@types.coroutine
+def profiled(coro, profile):
+    # drives coro one step at a time with the profiler on only while it runs, so whatever else
+    # the event loop does between steps never shows up in its profile
+    value = None
+    error = None
+    while True:
+        profile.enable()
+        try:
+            if error is None:
+                future = coro.send(value)
+            else:
+                future = coro.throw(error)
+        except StopIteration as e:
+            return e.value
+        finally:
+            profile.disable()
+        try:
+            value = yield future
+            error = None
+        except GeneratorExit:
+            coro.close()
+            raise
+        except BaseException as e:
+            value = None
+            error = e
+
+
+class CommandProfiler:
+    # off until configured with command names or a sampling rate. profiles of the same command
+    # are merged and written to out_dir as <command>.prof (for pstats/snakeviz) and <command>.txt (top functions).
+    def __init__(self, out_dir, top=30):
+        self.out_dir = out_dir
+        self.top = top
+        self.commands = frozenset()
+        self.rate = 0.0
+        self.active = False
+        # command name -> (pstats.Stats, invocations, total seconds)
+        self.stats = {}
+        self.control_mtime = None
+        self.task = None
+
+    def configure(self, commands=(), rate=0.0, top=None):
+        self.commands = frozenset(commands)
+        self.rate = rate
+        if top:
+            self.top = top
+        self.active = bool(self.commands or self.rate)
+
+    def should_profile(self, name):
+        return name in self.commands or (self.rate and random.random() < self.rate)
+
+    def wrap(self, name, func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not self.active or not self.should_profile(name):
+                return await func(*args, **kwargs)
+            profile = cProfile.Profile()
+            start = time.perf_counter()
+            try:
+                return await profiled(func(*args, **kwargs), profile)
+            finally:
+                self.record(name, profile, time.perf_counter() - start)
+        return wrapper
+
+    def record(self, name, profile, elapsed):
+        stats, invocations, total = self.stats.get(name, (None, 0, 0.0))
+        if stats is None:
+            stats = pstats.Stats(profile)
+        else:
+            stats.add(profile)
+        self.stats[name] = (stats, invocations + 1, total + elapsed)
+        try:
+            self.write(name)
+        except IOError as e:
+            print('Unable to write profile for "{}": {}'.format(name, e))
+
+    def write(self, name):
+        stats, invocations, total = self.stats[name]
+        os.makedirs(self.out_dir, exist_ok=True)
+        path = os.path.join(self.out_dir, re.sub(r'\W+', '_', name).strip('_') or 'command')
+        stats.dump_stats(path + '.prof')
+        report = io.StringIO()
+        report.write('{}: {} invocations, {:.3f}s total, {:.3f}s average wall time\n\n'.format(name, invocations, total, total / invocations))
+        stats.stream = report
+        for sort_key in ('tottime', 'cumulative'):
+            report.write('Top {} by {}:\n'.format(self.top, sort_key))
+            stats.sort_stats(sort_key).print_stats(self.top)
+        temp_path = path + '.txt.temp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(report.getvalue())
+        os.replace(temp_path, path + '.txt')
+
+    def load_control(self, path):
+        # {"commands": ["!leaderboard"], "rate": 0.01, "top": 30}. no file means profiling is off.
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            if self.control_mtime is not None:
+                self.control_mtime = None
+                self.configure()
+            return
+        if mtime == self.control_mtime:
+            return
+        self.control_mtime = mtime
+        try:
+            control = json.load(open(path, 'r', encoding='utf-8'))
+            self.configure(control.get('commands', ()), float(control.get('rate', 0.0)), control.get('top', None))
+        except (IOError, ValueError, AttributeError) as e:
+            print('Unable to load profiler control "{}": {}'.format(path, e))
+            return
+        print('Profiling {} at rate {}.'.format(u', '.join(sorted(self.commands)) or u'no commands', self.rate))
+
+    def watch(self, loop, path, interval):
+        if self.task is None or self.task.done():
+            self.task = loop.create_task(self.run(path, interval))
+
+    async def run(self, path, interval):
+        while True:
+            self.load_control(path)
+            await asyncio.sleep(interval)
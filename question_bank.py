@@ -0,0 +1,150 @@
+import json
+import os
+import random
+import re
+import sqlite3
+import time
+import unicodedata
+from array import array
+
+from millionaire_stats import *
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS questions (
+    id INTEGER PRIMARY KEY,
+    normalized TEXT NOT NULL UNIQUE,
+    category TEXT NOT NULL,
+    type TEXT NOT NULL,
+    difficulty TEXT NOT NULL,
+    question TEXT NOT NULL,
+    correct_answer TEXT NOT NULL,
+    incorrect_answers TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS questions_category ON questions (category, difficulty, type);
+CREATE INDEX IF NOT EXISTS questions_difficulty ON questions (difficulty, type);
+CREATE INDEX IF NOT EXISTS questions_type ON questions (type);
+CREATE TABLE IF NOT EXISTS imports (
+    name TEXT PRIMARY KEY,
+    finished REAL NOT NULL
+);
+'''
+
+# name of the one-time import of questions from Millionaire history, see QuestionBank.has_imported
+MILLIONAIRE_HISTORY_IMPORT = 'millionaire_history'
+
+COLUMNS = ('category', 'type', 'difficulty', 'question', 'correct_answer', 'incorrect_answers')
+
+
+def normalize_question(text):
+    text = unicodedata.normalize('NFKD', text).lower()
+    text = re.sub(r'[^\w\s]', '', text)
+    return u' '.join(text.split())
+
+
+class QuestionBank:
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+        # (category, difficulty, type) -> ids of matching rows, None matches anything. filled lazily
+        self.ids = {}
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM questions').fetchone()[0]
+
+    def add(self, questions):
+        added = []
+        with self.connection:
+            for question in questions:
+                cursor = self.connection.execute(
+                    'INSERT OR IGNORE INTO questions (normalized, {}) VALUES (?, ?, ?, ?, ?, ?, ?)'.format(', '.join(COLUMNS)),
+                    (normalize_question(question.question),
+                     question.category,
+                     question.type,
+                     question.difficulty,
+                     question.question,
+                     question.correct_answer,
+                     json.dumps(question.incorrect_answers)))
+                if cursor.rowcount:
+                    added.append((cursor.lastrowid, question))
+        for key, ids in self.ids.items():
+            for question_id, question in added:
+                if all(value is None or value == getattr(question, name) for name, value in zip(('category', 'difficulty', 'type'), key)):
+                    ids.append(question_id)
+        return len(added)
+
+    def has_imported(self, name):
+        return self.connection.execute('SELECT 1 FROM imports WHERE name = ?', (name,)).fetchone() is not None
+
+    def mark_imported(self, name):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO imports (name, finished) VALUES (?, ?)', (name, time.time()))
+
+    def get_ids(self, category=None, difficulty=None, question_type=None):
+        key = (category, difficulty, question_type)
+        ids = self.ids.get(key, None)
+        if ids is None:
+            conditions = [(name, value) for name, value in zip(('category', 'difficulty', 'type'), key) if value is not None]
+            where = ' AND '.join('{} = ?'.format(name) for name, _ in conditions) or '1'
+            rows = self.connection.execute('SELECT id FROM questions WHERE {}'.format(where), [value for _, value in conditions])
+            ids = self.ids[key] = array('q', (row[0] for row in rows))
+        return ids
+
+    def sample(self, amount, category=None, difficulty=None, question_type='multiple'):
+        ids = self.get_ids(category, difficulty, question_type)
+        if len(ids) < amount:
+            return None
+        chosen = [ids[index] for index in random.sample(range(len(ids)), amount)]
+        rows = self.connection.execute(
+            'SELECT id, {} FROM questions WHERE id IN ({})'.format(', '.join(COLUMNS), ', '.join('?' * amount)), chosen)
+        questions = {}
+        for question_id, *values in rows:
+            question = Question()
+            for name, value in zip(COLUMNS, values):
+                setattr(question, name, value)
+            question.incorrect_answers = json.loads(question.incorrect_answers)
+            questions[question_id] = question
+        return [questions[question_id] for question_id in chosen]
+
+    def close(self):
+        self.connection.close()
+
+
+def read_millionaire_history(stats_dir, ext='.mgd'):
+    # every distinct question asked in stats_dir. doesn't touch a QuestionBank, so it can run on another thread
+    if not os.path.isdir(stats_dir):
+        return []
+    questions = {}
+    for filename in sorted(next(os.walk(stats_dir))[2]):
+        if filename.endswith(ext):
+            path = os.path.join(stats_dir, filename)
+            with open(path, 'rb') as read_byte_stream:
+                version = read_header(read_byte_stream)
+            # version 2+ questions all live in the question table
+            if version < 2:
+                for game, _ in mmap_read_games(path):
+                    for round in game.rounds:
+                        questions.setdefault(normalize_question(round.question.question), round.question)
+    # a table of its own rather than the shared one, which the bot may be appending to meanwhile
+    for question in QuestionTable(os.path.join(stats_dir, QUESTION_TABLE_FILENAME)).questions:
+        questions.setdefault(normalize_question(question.question), question)
+    return list(questions.values())
+
+
+def import_millionaire_history(question_bank, stats_dir, ext='.mgd', questions=None):
+    # questions, if already read with read_millionaire_history
+    if questions is None:
+        questions = read_millionaire_history(stats_dir, ext)
+    added = question_bank.add(questions)
+    question_bank.mark_imported(MILLIONAIRE_HISTORY_IMPORT)
+    return added
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) >= 3 and sys.argv[1] == 'import':
+        question_bank = QuestionBank(sys.argv[2])
+        stats_dir = sys.argv[3] if len(sys.argv) > 3 else 'millionaire_stats'
+        print('Imported {:,} questions, {:,} total.'.format(import_millionaire_history(question_bank, stats_dir), len(question_bank)))
+    else:
+        print('usage: python question_bank.py import <bank_path> [stats_dir]')
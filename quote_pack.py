@@ -0,0 +1,169 @@
+import json
+import mmap
+import os
+import random
+import struct
+
+from fileutil import atomic_write_json
+
+
+PACK_MAGIC = b'MQP'
+PACK_VERSION = 1
+
+# data offset, title id
+INDEX_ENTRY = struct.Struct('<QI')
+STRING_LENGTH = struct.Struct('<H')
+NO_CHARACTER = 0xFFFF
+
+
+def encode_string(s):
+    str_bytes = bytes(s, encoding='utf-8')
+    if len(str_bytes) >= NO_CHARACTER:
+        # cut on a character boundary so it still decodes
+        str_bytes = str_bytes[:NO_CHARACTER - 1].decode('utf-8', 'ignore').encode('utf-8')
+    return STRING_LENGTH.pack(len(str_bytes)) + str_bytes
+
+
+class QuotePack:
+    # Files, all sharing one base path:
+    #   .pack           magic, version, then Quote records (u16 length + UTF-8 text, u16 length + UTF-8 character)
+    #   .idx            one INDEX_ENTRY per quote, in the order they were appended
+    #   .manifest.json  titles and the live [first, count] range of .idx entries for each
+    # re-saving a title appends a new range, the old one is simply never picked again.
+    def __init__(self, path, key=str.lower):
+        self.data_path = path + '.pack'
+        self.index_path = path + '.idx'
+        self.manifest_path = path + '.manifest.json'
+        self.key = key
+        try:
+            manifest = json.load(open(self.manifest_path, 'r', encoding='utf-8'))
+        except IOError:
+            manifest = {'titles': [], 'ranges': [], 'entries': 0}
+        self.titles = manifest['titles']
+        self.ranges = manifest['ranges']
+        # anything in .idx past this was written by an append that never finished
+        self.entries = manifest['entries']
+        self.title_ids = {key(title): title_id for title_id, title in enumerate(self.titles)}
+        # ids of titles with at least one quote, what a random quote picks from
+        self.quoted_title_ids = [title_id for title_id, (first, count) in enumerate(self.ranges) if count]
+        self.data = None
+        self.index = None
+
+    @classmethod
+    def open(cls, path, key=str.lower):
+        if os.path.exists(path + '.manifest.json'):
+            return cls(path, key)
+        return None
+
+    def map(self):
+        if self.data is None:
+            with open(self.data_path, 'rb') as read_byte_stream:
+                self.data = mmap.mmap(read_byte_stream.fileno(), 0, access=mmap.ACCESS_READ)
+            with open(self.index_path, 'rb') as read_byte_stream:
+                self.index = mmap.mmap(read_byte_stream.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def unmap(self):
+        if self.data is not None:
+            self.data.close()
+            self.index.close()
+            self.data = self.index = None
+
+    def find(self, title):
+        return self.title_ids.get(self.key(title), None)
+
+    def read_entry(self, entry):
+        return INDEX_ENTRY.unpack_from(self.index, entry * INDEX_ENTRY.size)
+
+    def read_quote(self, offset):
+        length, = STRING_LENGTH.unpack_from(self.data, offset)
+        offset += STRING_LENGTH.size
+        text = str(self.data[offset:offset + length], encoding='utf-8')
+        offset += length
+        length, = STRING_LENGTH.unpack_from(self.data, offset)
+        offset += STRING_LENGTH.size
+        character = None if length == NO_CHARACTER else str(self.data[offset:offset + length], encoding='utf-8')
+        return text, character
+
+    def random_quote(self, title=None):
+        # (title, text, character) or None. without a title, a random title first and then one of its quotes,
+        # like picking a random quote file
+        if title is None:
+            if not self.quoted_title_ids:
+                return None
+            title_id = random.choice(self.quoted_title_ids)
+        else:
+            title_id = self.find(title)
+            if title_id is None or not self.ranges[title_id][1]:
+                return None
+        self.map()
+        first, count = self.ranges[title_id]
+        offset, _ = self.read_entry(first + random.randrange(count))
+        return (self.titles[title_id], *self.read_quote(offset))
+
+    def read_quotes(self, title):
+        title_id = self.find(title)
+        if title_id is None or not self.ranges[title_id][1]:
+            return []
+        self.map()
+        first, count = self.ranges[title_id]
+        return [self.read_quote(self.read_entry(entry)[0]) for entry in range(first, first + count)]
+
+    def append(self, title, quotes, save_manifest=True):
+        # quotes is a list of (text, character)
+        title_id = self.find(title)
+        if title_id is None:
+            title_id = len(self.titles)
+            self.titles.append(title)
+            self.ranges.append([0, 0])
+            self.title_ids[self.key(title)] = title_id
+        self.unmap()
+        with open(self.data_path, 'ab') as data_stream, open(self.index_path, 'ab') as index_stream:
+            if not data_stream.tell():
+                data_stream.write(PACK_MAGIC + bytes([PACK_VERSION]))
+            index_stream.truncate(self.entries * INDEX_ENTRY.size)
+            entries = []
+            for text, character in quotes:
+                entries.append(INDEX_ENTRY.pack(data_stream.tell(), title_id))
+                data_stream.write(encode_string(text))
+                data_stream.write(STRING_LENGTH.pack(NO_CHARACTER) if character is None else encode_string(character))
+            index_stream.write(b''.join(entries))
+        had_quotes = bool(self.ranges[title_id][1])
+        self.ranges[title_id] = [self.entries, len(quotes)]
+        if quotes and not had_quotes:
+            self.quoted_title_ids.append(title_id)
+        elif had_quotes and not quotes:
+            self.quoted_title_ids.remove(title_id)
+        self.entries += len(quotes)
+        if save_manifest:
+            self.save_manifest()
+
+    def save_manifest(self):
+        atomic_write_json(self.manifest_path, {'titles': self.titles, 'ranges': self.ranges, 'entries': self.entries})
+
+    def close(self):
+        self.unmap()
+
+
+def build_quote_pack(quotes_dir, path, key=str.lower):
+    for ext in ('.pack', '.idx', '.manifest.json'):
+        try:
+            os.remove(path + ext)
+        except FileNotFoundError:
+            pass
+    quote_pack = QuotePack(path, key)
+    for filename in sorted(next(os.walk(quotes_dir))[2]):
+        if filename.endswith('.json'):
+            movie = json.load(open(os.path.join(quotes_dir, filename), 'r', encoding='utf-8'))
+            quote_pack.append(movie['title'], [(quote['text'], quote['character']) for quote in movie['quotes']], save_manifest=False)
+    quote_pack.save_manifest()
+    return quote_pack
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) >= 2 and sys.argv[1] == 'build':
+        quotes_dir = sys.argv[2] if len(sys.argv) > 2 else 'movie_quotes'
+        quote_pack = build_quote_pack(quotes_dir, sys.argv[3] if len(sys.argv) > 3 else quotes_dir)
+        print('Packed {:,} quotes from {:,} titles.'.format(quote_pack.entries, len(quote_pack.titles)))
+    else:
+        print('usage: python quote_pack.py build [quotes_dir] [pack_path]')
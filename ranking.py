@@ -0,0 +1,44 @@
+import bisect
+
+
+class Ranking:
+    # members kept in one sorted list per ordering, highest score first. rank and position lookups are a bisect,
+    # an update is a bisect plus a list shift.
+    def __init__(self, orderings):
+        # ordering name -> fn(item) -> score
+        self.orderings = orderings
+        # ordering name -> [(-score, member)]
+        self.ranked = {name: [] for name in orderings}
+        # member -> {ordering name: (-score, member)}
+        self.members = {}
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, member):
+        return member in self.members
+
+    def update(self, member, item):
+        self.remove(member)
+        entries = self.members[member] = {}
+        for name, score in self.orderings.items():
+            entry = entries[name] = (-score(item), member)
+            bisect.insort(self.ranked[name], entry)
+
+    def remove(self, member):
+        entries = self.members.pop(member, None)
+        if entries:
+            for name, entry in entries.items():
+                ranked = self.ranked[name]
+                del ranked[bisect.bisect_left(ranked, entry)]
+
+    def rank(self, name, member):
+        # 1-based, players with the same score share a rank
+        entry = self.members.get(member, {}).get(name, None)
+        if entry is None:
+            return None
+        return bisect.bisect_left(self.ranked[name], (entry[0],)) + 1
+
+    def top(self, name, count, start=0):
+        # [(member, score)]
+        return [(member, -score) for score, member in self.ranked[name][start:start + count]]
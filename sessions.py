@@ -0,0 +1,98 @@
+import asyncio
+
+
+class Timer:
+    def __init__(self, wheel, callback, rounds, slot):
+        self.wheel = wheel
+        self.callback = callback
+        self.rounds = rounds
+        self.slot = slot
+
+    def cancel(self):
+        self.wheel.slots[self.slot].discard(self)
+
+
+class TimerWheel:
+    # hashed timer wheel driven by a single task. scheduling and cancelling are O(1),
+    # each tick only looks at the timers in one slot.
+    def __init__(self, tick=0.5, slots=512):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.position = 0
+        self.task = None
+
+    def start(self, loop):
+        if self.task is None or self.task.done():
+            self.task = loop.create_task(self.run())
+
+    def schedule(self, delay, callback):
+        ticks = max([1, int(-(-delay // self.tick))])
+        rounds, offset = divmod(ticks - 1, len(self.slots))
+        slot = (self.position + 1 + offset) % len(self.slots)
+        timer = Timer(self, callback, rounds, slot)
+        self.slots[slot].add(timer)
+        return timer
+
+    def advance(self):
+        self.position = (self.position + 1) % len(self.slots)
+        slot = self.slots[self.position]
+        for timer in list(slot):
+            if timer.rounds:
+                timer.rounds -= 1
+            else:
+                slot.discard(timer)
+                timer.callback()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            self.advance()
+
+
+class GameSession:
+    def __init__(self, manager, channel_id, name):
+        self.manager = manager
+        self.channel_id = channel_id
+        self.name = name
+        self.future = None
+        self.check = None
+
+    async def wait_for_message(self, check, timeout):
+        # like client.wait_for_message, but only this channel's messages ever reach check
+        future = self.future = asyncio.get_event_loop().create_future()
+        self.check = check
+        timer = self.manager.timers.schedule(timeout, lambda: future.done() or future.set_result(None))
+        try:
+            return await future
+        finally:
+            timer.cancel()
+            self.future = self.check = None
+
+    def feed(self, message):
+        if self.future is not None and not self.future.done() and self.check(message):
+            self.future.set_result(message)
+
+
+class SessionManager:
+    # owns the one game allowed per channel and routes each message straight to it
+    def __init__(self, timers):
+        self.timers = timers
+        self.sessions = {}
+
+    def get(self, channel_id):
+        return self.sessions.get(channel_id, None)
+
+    def open(self, channel_id, name):
+        if channel_id in self.sessions:
+            return None
+        session = self.sessions[channel_id] = GameSession(self, channel_id, name)
+        return session
+
+    def close(self, session):
+        if self.sessions.get(session.channel_id, None) is session:
+            del self.sessions[session.channel_id]
+
+    def route(self, channel_id, message):
+        session = self.sessions.get(channel_id, None)
+        if session is not None:
+            session.feed(message)
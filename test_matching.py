@@ -0,0 +1,39 @@
+import pytest
+
+from matching import AnswerMatcher, sequel_tokens
+
+
+@pytest.mark.parametrize('answer, text', [
+    ('Tony Stark', 'Tony Stark'),
+    ('Tony Stark', 'tony'),
+    ('Tony Stark', 'stark!'),
+    ('Darth Vader', 'darth vadr'),
+    ('Hannibal Lecter', 'hanibal'),
+    ('Old Man', 'the old man'),
+    ('Doc Brown', 'brown'),
+])
+def test_matches(answer, text):
+    assert AnswerMatcher(answer).match(text)
+
+
+@pytest.mark.parametrize('answer, text', [
+    # no typos in short words
+    ('Doc Brown', 'crown'),
+    # a part too short to stand for the whole name
+    ('Old Man', 'hello old friend'),
+    ('Doc Brown', 'doc'),
+])
+def test_does_not_match(answer, text):
+    assert not AnswerMatcher(answer).match(text)
+
+
+@pytest.mark.parametrize('a, b, same', [
+    ('Alien', 'Alien 3', False),
+    ('Toy Story', 'Toy Story 2', False),
+    ('The Godfather Part II', 'The Godfathr part II', True),
+    ('The Dark Knight', 'The Dark Knight Rises', False),
+    ('Rocky IV', 'rocky iv', True),
+    ('Back to the Future', 'Back to the Futur', True),
+])
+def test_sequel_tokens(a, b, same):
+    assert (sequel_tokens(a) == sequel_tokens(b)) == same
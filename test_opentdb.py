@@ -0,0 +1,151 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from opentdb import OpenTDBClient, ResponseCache
+
+
+CATEGORIES = {'trivia_categories': [{'id': 9, 'name': 'General Knowledge'}]}
+
+
+class StubOpenTDB(ThreadingHTTPServer):
+    # answers every request after delay seconds, and keeps count of how many it was handling at once
+    daemon_threads = True
+
+    def __init__(self, delay=0.0):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.delay = delay
+        self.etag = '"v1"'
+        self.requests = 0
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/'.format(self.server_address[1])
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            time.sleep(server.delay)
+            if self.headers.get('If-None-Match', None) == server.etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = json.dumps(CATEGORIES if self.path.startswith('/api_category.php') else {'response_code': 0, 'results': []}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', server.etag)
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client already gave up on a slow response
+            pass
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub():
+    server = StubOpenTDB()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_requests_are_concurrent_up_to_the_limit(stub):
+    stub.delay = 0.2
+
+    async def main():
+        client = OpenTDBClient(stub.url, timeout=5, max_concurrency=4)
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        ticking = asyncio.ensure_future(ticker())
+        start = time.perf_counter()
+        try:
+            await asyncio.gather(*[client.get_questions(1) for _ in range(8)])
+        finally:
+            ticking.cancel()
+            client.close()
+        return time.perf_counter() - start, ticks
+
+    elapsed, ticks = run(main())
+    assert stub.requests == 8
+    assert stub.max_active == 4
+    # two rounds of four, not eight one after another
+    assert elapsed < 0.2 * 8 / 2
+    # the event loop kept running while the requests were waiting
+    assert ticks > 20
+
+
+def test_slow_responses_time_out(stub):
+    stub.delay = 1.0
+
+    async def main():
+        client = OpenTDBClient(stub.url, timeout=0.2)
+        try:
+            await client.get_questions(1)
+        finally:
+            client.close()
+
+    with pytest.raises(requests.Timeout):
+        run(main())
+
+
+def test_cached_categories(stub, tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.json'), ttl=60)
+
+    async def get():
+        client = OpenTDBClient(stub.url, timeout=0.5, cache=cache)
+        try:
+            return await client.get_categories()
+        finally:
+            client.close()
+
+    assert run(get()) == CATEGORIES
+    assert stub.requests == 1
+    # fresh, no request at all
+    assert run(get()) == CATEGORIES
+    assert stub.requests == 1
+    # stale, revalidated with the ETag and answered with a 304
+    cache.ttl = 0
+    assert run(get()) == CATEGORIES
+    assert stub.requests == 2
+    # stale and the server is too slow, the stale copy is served
+    stub.delay = 1.0
+    assert run(get()) == CATEGORIES
+    # and it survives a restart
+    assert ResponseCache(cache.path, ttl=60).get('api_category.php?')['body'] == CATEGORIES
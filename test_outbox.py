@@ -0,0 +1,148 @@
+import asyncio
+import time
+
+import pytest
+
+from benchmarks import FakeDiscord, retry_after
+from outbox import Outbox
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+async def drain(outbox):
+    await asyncio.gather(*[queue.task for queue in outbox.channels.values() if queue.task])
+
+
+def test_order_and_rate_limits_across_channels():
+    discord = FakeDiscord(limit=5, period=0.2)
+    outbox = Outbox(discord.send_message, limit=5, period=0.2, max_pending=10, retry_after=retry_after)
+
+    async def game(channel):
+        for i in range(60):
+            await outbox.post(channel, u'{} {}'.format(channel, i))
+            if i % 7 == 0:
+                await asyncio.sleep(0.01)
+
+    async def main():
+        await asyncio.gather(*[game(channel) for channel in range(4)])
+        await drain(outbox)
+
+    run(main())
+    for channel in range(4):
+        assert discord.lines(channel) == [u'{} {}'.format(channel, i) for i in range(60)]
+    # waiting messages were merged, and the outbox stayed inside every window the server counted
+    assert len(discord.sent) < 4 * 60
+    assert outbox.coalesced == 4 * 60 - len(discord.sent)
+    assert discord.rejected == 0
+
+
+def test_rate_limited_sends_are_retried():
+    # the outbox thinks it may send twice as often as the server allows
+    discord = FakeDiscord(limit=3, period=0.2)
+    outbox = Outbox(discord.send_message, limit=6, period=0.2, max_length=5, retry_after=retry_after)
+
+    async def main():
+        for i in range(20):
+            await outbox.post('channel', u'm{:02}'.format(i))
+        await drain(outbox)
+
+    run(main())
+    assert discord.rejected
+    assert discord.lines('channel') == [u'm{:02}'.format(i) for i in range(20)]
+
+
+def test_merging_respects_max_length_and_kwargs():
+    discord = FakeDiscord(limit=100, period=1.0)
+    outbox = Outbox(discord.send_message, limit=100, period=1.0, max_length=2000)
+
+    async def main():
+        for _ in range(5):
+            await outbox.post('channel', u'x' * 900)
+        await outbox.post('channel', u'spoken', tts=True)
+        await outbox.post('channel', u'after')
+        await drain(outbox)
+
+    run(main())
+    assert [len(content) for _, content, _, _ in discord.sent] == [1801, 1801, 900, 6, 5]
+    assert discord.sent[3][2] == {'tts': True}
+
+
+def test_send_returns_the_message_once_delivered():
+    discord = FakeDiscord()
+    outbox = Outbox(discord.send_message)
+
+    async def main():
+        await outbox.post('channel', u'first')
+        await outbox.post('channel', u'queued')
+        message = await outbox.send('channel', u'prompt')
+        return message, time.monotonic()
+
+    message, returned = run(main())
+    # the prompt was merged with the lines queued ahead of it, and only returned once it was sent
+    assert message == ('channel', u'first\nqueued\nprompt')
+    assert len(discord.sent) == 1
+    assert returned >= discord.sent[-1][3]
+
+
+def test_errors_reach_send_and_are_printed_for_posts(capsys):
+    discord = FakeDiscord()
+    discord.error = ValueError('nope')
+    outbox = Outbox(discord.send_message)
+
+    async def main():
+        with pytest.raises(ValueError):
+            await outbox.send('channel', u'a')
+        await outbox.post('channel', u'b')
+        await drain(outbox)
+
+    run(main())
+    assert 'nope' in capsys.readouterr().out
+
+
+def test_post_waits_for_room_in_the_queue():
+    discord = FakeDiscord(limit=100)
+    outbox = Outbox(discord.send_message, limit=100, max_pending=3)
+
+    async def main():
+        discord.blocked = asyncio.Event()
+        for _ in range(3):
+            await outbox.post('channel', u'm')
+        extra = asyncio.ensure_future(outbox.post('channel', u'm'))
+        await asyncio.sleep(0.05)
+        full = not extra.done()
+        discord.blocked.set()
+        await extra
+        await drain(outbox)
+        return full
+
+    assert run(main())
+    assert discord.lines('channel') == [u'm'] * 4
+
+
+def test_a_cancelled_send_does_not_strand_the_rest():
+    discord = FakeDiscord()
+    outbox = Outbox(discord.send_message)
+
+    async def main():
+        discord.blocked = asyncio.Event()
+        await outbox.post('channel', u'first')
+        cancelled = asyncio.ensure_future(outbox.send('channel', u'gone'))
+        kept = asyncio.ensure_future(outbox.send('channel', u'kept'))
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        discord.blocked.set()
+        message = await asyncio.wait_for(kept, 1)
+        # and the channel still delivers afterwards
+        await outbox.post('channel', u'after')
+        await drain(outbox)
+        return message
+
+    # both sends were merged while the first post was on its way
+    assert run(main()) == ('channel', u'gone\nkept')
+    assert discord.lines('channel') == [u'first', u'gone', u'kept', u'after']
@@ -0,0 +1,27 @@
+import os
+import subprocess
+import sys
+
+from benchmarks import write_history
+from worker_pool import CODE_DIR
+
+
+def test_workers_import_the_code_from_a_data_directory(tmp_path):
+    # run from a directory holding millionaire_stats/ game files, which the workers would otherwise import as an
+    # empty namespace package in place of millionaire_stats.py
+    user_ids = write_history(str(tmp_path / 'millionaire_stats'), 3, 2)
+    script = u'''
+import os, sys
+sys.path.insert(0, {code_dir!r})
+from millionaire_stats import summarize_game_files
+from worker_pool import create_worker_pool
+sys.path.remove({code_dir!r})
+pool = create_worker_pool(2)
+jobs = [(os.path.join('millionaire_stats', user_id + '.mgd'), None) for user_id in {user_ids!r}]
+print([summary.games_played for summary in pool.submit(summarize_game_files, jobs).result(timeout=30)])
+pool.shutdown()
+'''.format(code_dir=CODE_DIR, user_ids=user_ids)
+    result = subprocess.run([sys.executable, '-c', script], cwd=str(tmp_path), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == '[2, 2, 2]'
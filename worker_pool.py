@@ -0,0 +1,29 @@
+import multiprocessing
+import os
+import site
+import sys
+import types
+from concurrent.futures import ProcessPoolExecutor
+
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def create_worker_pool(workers, code_dir=CODE_DIR):
+    # workers start from a fresh interpreter (forkserver, or spawn where there's none) rather than a fork of a
+    # process that already has threads running. a fresh worker normally re-imports the parent's __main__ first,
+    # so it's hidden while they start, leaving them with just what their jobs import. code_dir is added to their
+    # sys.path: the parent's may only lead to a data directory, whose millionaire_stats/ would be imported as an
+    # empty namespace package. a module found anywhere on the path wins over that.
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    pool = ProcessPoolExecutor(workers, mp_context=context, initializer=site.addsitedir, initargs=(code_dir,))
+    main = sys.modules['__main__']
+    sys.modules['__main__'] = types.ModuleType('__main__')
+    try:
+        # every submit that finds no idle worker starts one, so this starts all of them now
+        for _ in range(workers):
+            pool.submit(int)
+    finally:
+        sys.modules['__main__'] = main
+    return pool